@@ -0,0 +1,144 @@
+#  Copyright 2023 by Ian Rist
+
+# Reads holder catalogs and turns them into holder tool data without needing any geometry.
+# Bad holders are reported one by one so a typo in one row doesn't stop the rest of the catalog from loading.
+#
+# CSV catalogs have one row per segment, consecutive rows with the same name are one holder:
+#   name,product_id,product_link,vendor,z1,z2,r1,r2
+# JSON catalogs are a list of holders:
+#   [{"name": "", "product-id": "", "product-link": "", "vendor": "", "segments": [[z1, z2, r1, r2], ...]}]
+# All of the lengths in a catalog are in millimeters, z is measured from the tool end of the holder and the segments run end to end from it.
+
+from typing import Dict, Iterator, List, Tuple
+import csv
+import hashlib
+import json
+import math
+import time
+import uuid
+
+class HolderSpec:
+    def __init__(self, name: str, prodid: str = '', prodlink: str = '', prodvendor: str = '', profile: List[List[float]] = None):
+        self.name = name
+        self.prodid = prodid
+        self.prodlink = prodlink
+        self.prodvendor = prodvendor
+        # [z1, z2, r1, r2] in cm, the same as get_tool_profile makes
+        self.profile = profile if profile is not None else []
+        # why the holder couldn't be read, a bad holder is still passed along so it can be reported
+        self.error: str = None
+
+def holder_data(profile: List[List[float]], desc: str, prodid: str, prodlink: str, prodvendor: str) -> dict:
+    # The tool library json for a holder, the profile is in cm and the library wants mm and diameters
+    data = {
+        "description": desc,
+        "last_modified": math.ceil(time.time()),
+        "product-id": prodid,
+        "product-link": prodlink,
+        "segments": [],
+        "type": "holder",
+        "unit": "millimeters",
+        "vendor": prodvendor,
+    }
+
+    for segment in profile:
+        seg = {
+            "height": round((segment[1] - segment[0])*10, 3),
+            "lower-diameter": round(segment[2]*10*2, 3),
+            "upper-diameter": round(segment[3]*10*2, 3)
+        }
+        data["segments"].append(seg)
+    # every holder gets its own guid, duplicates are found by the fingerprint in HolderIndex instead
+    guid = str(uuid.uuid4())
+    data["guid"] = guid
+    data["reference_guid"] = guid
+    return data
+
+def holder_fingerprint(data: dict, quantum: float = 0.01) -> str:
+    # Only the shape counts, the segments are put in mm and snapped to quantum so float noise and units don't matter
+    scale = 25.4 if data.get("unit", "millimeters") == "inches" else 1.0
+    key = ';'.join(f'{round(segment["height"] * scale / quantum)},{round(segment["lower-diameter"] * scale / quantum)},{round(segment["upper-diameter"] * scale / quantum)}' for segment in data.get("segments", []))
+    return hashlib.sha1(key.encode()).hexdigest()
+
+class HolderIndex:
+    ''' The holders in a library by fingerprint, built once so every duplicate check is a dictionary lookup '''
+    def __init__(self):
+        # fingerprint -> (position in the library, description)
+        self.entries: Dict[str, Tuple[int, str]] = {}
+
+    def add(self, data: dict, position: int):
+        self.entries.setdefault(holder_fingerprint(data), (position, data.get("description", '')))
+
+    def find(self, data: dict) -> Tuple[int, str]:
+        return self.entries.get(holder_fingerprint(data))
+
+    def remove(self, data: dict):
+        self.entries.pop(holder_fingerprint(data), None)
+
+def _segment_from_mm(values) -> List[float]:
+    z_1, z_2, r_1, r_2 = [float(v) / 10 for v in values]
+    if z_2 < z_1:
+        z_1, z_2, r_1, r_2 = z_2, z_1, r_2, r_1
+    return [z_1, z_2, r_1, r_2]
+
+def read_csv_catalog(path: str) -> Iterator[HolderSpec]:
+    # Streams the holders out one at a time so large catalogs never have to be in memory all at once
+    with open(path, newline='') as csvfile:
+        reader = csv.DictReader(csvfile)
+        holder = None
+        for row in reader:
+            name = (row.get('name') or '').strip()
+            if holder is None or name != holder.name:
+                if holder is not None:
+                    yield holder
+                holder = HolderSpec(name, row.get('product_id', '') or '', row.get('product_link', '') or '', row.get('vendor', '') or '')
+            if holder.error is not None:
+                continue
+            # one bad row only loses its own holder
+            try:
+                holder.profile.append(_segment_from_mm([row['z1'], row['z2'], row['r1'], row['r2']]))
+            except (KeyError, TypeError, ValueError) as e:
+                holder.error = f'line {reader.line_num}: {e!r}'
+        if holder is not None:
+            yield holder
+
+def read_json_catalog(path: str) -> Iterator[HolderSpec]:
+    with open(path, 'r') as file:
+        catalog = json.load(file)
+    for i, entry in enumerate(catalog):
+        try:
+            profile = [_segment_from_mm(segment) for segment in entry["segments"]]
+            yield HolderSpec(entry["name"], entry.get("product-id", ''), entry.get("product-link", ''), entry.get("vendor", ''), profile)
+        except (AttributeError, KeyError, TypeError, ValueError) as e:
+            holder = HolderSpec(entry.get("name", f'entry {i}') if isinstance(entry, dict) else f'entry {i}')
+            holder.error = f'entry {i}: {e!r}'
+            yield holder
+
+def read_catalog(path: str) -> Iterator[HolderSpec]:
+    if path.lower().endswith('.json'):
+        return read_json_catalog(path)
+    return read_csv_catalog(path)
+
+def profile_error(profile: List[List[float]], tol: float = 1e-4) -> str:
+    # The library only stores segment heights, so the segments have to run end to end from the tool end or the shape would change
+    if len(profile) == 0:
+        return 'no segments'
+    z = 0.0
+    for segment in profile:
+        if abs(segment[0] - z) > tol:
+            kind = 'gap' if segment[0] > z else 'overlap'
+            return f'{kind} between z {z * 10:g} mm and {segment[0] * 10:g} mm'
+        z = segment[1]
+    return None
+
+def catalog_holder_data(path: str) -> Iterator[Tuple[str, dict, str]]:
+    # (name, holder json, error) for every holder in the catalog, the json is None if the holder couldn't be read
+    # the segments are sorted along the axis the same way a profile would be
+    for holder in read_catalog(path):
+        if holder.error is None:
+            holder.profile.sort(key=lambda segment: segment[0])
+            holder.error = profile_error(holder.profile)
+        if holder.error is not None:
+            yield holder.name, None, holder.error
+            continue
+        yield holder.name, holder_data(holder.profile, holder.name, holder.prodid, holder.prodlink, holder.prodvendor), None
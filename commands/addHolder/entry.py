@@ -3,11 +3,14 @@ import adsk.core, adsk.fusion, adsk.cam, traceback
 import os
 from ...lib import fusion360utils as futil
 from ... import config
+from ... import shared_state
+from ...selection_tracker import SelectionTracker
 import time
-import random
 from typing import List
 import math
 from adsk.cam import ToolLibrary, Tool
+from . import profile as holder_profile
+from . import catalog
 
 app = adsk.core.Application.get()
 ui = app.userInterface
@@ -23,9 +26,40 @@ COMMAND_BESIDE_ID = ''
 
 ICON_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'resources', '')
 
+DEFAULT_SETTINGS = {
+    "profile_tolerance": {
+        "type": "dropdown",
+        "label": "Profile Simplification Tolerance (mm)",
+        "options": ["0", "0.001", "0.01", "0.05", "0.1"],
+        "default": "0.01"
+    },
+    "extraction": {
+        "type": "dropdown",
+        "label": "Profile Extraction",
+        "options": ["Automatic", "Analytic Faces", "Tessellated"],
+        "default": "Automatic"
+    },
+    "duplicates": {
+        "type": "dropdown",
+        "label": "When a Holder Already Exists",
+        "options": ["Ask", "Reuse Existing", "Replace Existing", "Add Anyway"],
+        "default": "Ask"
+    }
+}
+
+# Initialize the settings on first use
+shared_state.load_settings_init(CMD_ID, CMD_NAME, DEFAULT_SETTINGS, ICON_FOLDER)
+
 # Local list of event handlers used to maintain a reference so
 # they are not released and garbage collected.
 local_handlers = []
+# Caches the axis line resolved from the axis selection so hovering over end faces doesn't resolve it again
+axis_tracker = SelectionTracker(lambda entity: get_axis(entity))
+# The extracted profile keyed by the selected bodies, axis and end datum so changing the name or vendor doesn't extract it again
+_profile_cache = {}
+_preview_group: adsk.fusion.CustomGraphicsGroup = None
+# The axis and end inferred from the selected bodies
+_inferred_axes = {}
 
 def start():
     cmd_def = ui.commandDefinitions.addButtonDefinition(CMD_ID, CMD_NAME, CMD_Description, ICON_FOLDER)
@@ -51,6 +85,9 @@ def stop():
 def command_created(args: adsk.core.CommandCreatedEventArgs):
     # General logging for debug.
     futil.log(f'{CMD_NAME} Command Created Event')
+    axis_tracker.clear()
+    _profile_cache.clear()
+    _inferred_axes.clear()
     futil.add_handler(args.command.execute, command_execute, local_handlers=local_handlers)
     futil.add_handler(args.command.inputChanged, command_input_changed, local_handlers=local_handlers)
     futil.add_handler(args.command.executePreview, command_preview, local_handlers=local_handlers)
@@ -59,21 +96,30 @@ def command_created(args: adsk.core.CommandCreatedEventArgs):
 
     inputs = args.command.commandInputs
 
-    # Option to select the tool body
-    body_input = inputs.addSelectionInput('body', 'Tool Body', 'Select the body to be used as the tool.')
-    body_input.selectionFilters = ['SolidBodies']
-    body_input.setSelectionLimits(1, 1)
+    # Option to select the tool bodies, a holder is often a few bodies like the collet nut, body and extension
+    body_input = inputs.addSelectionInput('body', 'Tool Bodies', 'Select the bodies or components to be used as the tool.')
+    body_input.selectionFilters = ['SolidBodies', 'MeshBodies', 'Occurrences']
+    body_input.setSelectionLimits(1, 0)
+
+    # Batch mode makes a holder out of every selected body or component and writes them all to the library at once
+    batch_input = inputs.addBoolValueInput('batch', 'One Holder per Selection', True, '', False)
+    batch_input.tooltip = 'Make a separate holder from each selected body or component, the axis and end are found automatically.'
+
+    # Vendors often only publish dimensions so we can also make holders straight from a table of segments
+    catalog_input = inputs.addBoolValueInput('catalog', 'Import from Catalog', True, '', False)
+    catalog_input.tooltip = 'Pick a CSV or JSON catalog of holder segments when you click OK, no geometry is needed.'
 
     # Option to select the central axis
+    # the axis and end are inferred from the bodies, picking them here overrides that
     axis_input = inputs.addSelectionInput('axis', 'Axis', 'Select the axis to be used as the axis of rotation.')
     axis_input.selectionFilters = ['ToroidalFaces', 'CylindricalFaces', 'ConicalFaces', 'LinearEdges', 'ConstructionLines']
-    axis_input.setSelectionLimits(1, 1)
+    axis_input.setSelectionLimits(0, 1)
     axis_input.isVisible = False
 
     # Option to select the end face of the tool
     end_face_input = inputs.addSelectionInput('end_face', 'End Face', 'Select the end face of the tool.')
     end_face_input.selectionFilters = ['PlanarFaces', 'Edges', 'Vertices']
-    end_face_input.setSelectionLimits(1, 1)
+    end_face_input.setSelectionLimits(0, 1)
     end_face_input.isVisible = False
 
     # Option to name the tool
@@ -105,17 +151,22 @@ def command_created(args: adsk.core.CommandCreatedEventArgs):
 def command_execute(args: adsk.core.CommandEventArgs):
     # General logging for debug
     inputs = args.command.commandInputs
-    # Get the selected body
-    body_input: adsk.core.SelectionCommandInput = inputs.itemById('body')
-    body = body_input.selection(0).entity
-    # Get the selected axis
-    axis_input: adsk.core.SelectionCommandInput = inputs.itemById('axis')
-    axis = get_axis(axis_input.selection(0).entity)
-    # Get the selected end face
-    end_face_input: adsk.core.SelectionCommandInput = inputs.itemById('end_face')
-    end_face = is_valid_axial_datum(end_face_input.selection(0).entity, axis)
-
-    tool_profile = get_tool_profile(body, axis, end_face)
+    if inputs.itemById('catalog').value:
+        add_holders_from_catalog(inputs)
+        return
+    if inputs.itemById('batch').value:
+        add_holders_batch(inputs)
+        return
+    # Get the profile of the selected bodies, this is normally already cached from the preview
+    axis_tracker.update(inputs.itemById('axis'))
+    cached = get_cached_profile(inputs)
+    if cached is None:
+        ui.messageBox('Could not find the axis and end of the holder, please select them.')
+        return
+    segment_count, tool_profile, _, _ = cached
+    if len(tool_profile) == 0:
+        ui.messageBox('No profile was found, check that the axis and end are on the holder.')
+        return
     
     # Get the name of the tool
     name_input = inputs.itemById('name')
@@ -130,10 +181,61 @@ def command_execute(args: adsk.core.CommandEventArgs):
     prodvendor_input = inputs.itemById('prodvendor')
     prodvendor = prodvendor_input.value
 
-    tool = generate_tool(tool_profile, name, prodid, prodlink, prodvendor)
-
-    futil.log(f'Tool:\n{tool.toJson()}')
+    data = catalog.holder_data(tool_profile, name, prodid, prodlink, prodvendor)
+    futil.log(f'Tool:\n{json.dumps(data)}')
 
+    library_url, library, toolLibraries = get_selected_library(inputs)
+    adder = HolderAdder(library)
+    result = adder.add(data)
+    if result == 'reused':
+        ui.messageBox('The existing holder was kept, the library was not changed')
+        return
+    adder.finish()
+    success = toolLibraries.updateToolLibrary(library_url, library)
+    if success:
+        message = f'Tool {result} in library successfully with {len(tool_profile)} segments (compacted from {segment_count})'
+        futil.log(message)
+        ui.messageBox(message)
+
+class HolderAdder:
+    ''' Adds holders to a library, checking a fingerprint index of the library first so the same holder isn't added twice.
+    Call finish before writing the library back so any replaced holders are removed. '''
+    def __init__(self, library: ToolLibrary):
+        self.library = library
+        self.index = catalog.HolderIndex()
+        for i in range(library.count):
+            data = json.loads(library.item(i).toJson())
+            if data.get("type") == "holder":
+                self.index.add(data, i)
+        self.action = shared_state.load_settings(CMD_ID)["duplicates"]["default"]
+        self.replaced: List[int] = []
+
+    def add(self, data: dict) -> str:
+        # Returns 'added', 'replaced' or 'reused'
+        existing = self.index.find(data)
+        action = self.action
+        if existing is not None and action == 'Ask':
+            answer = ui.messageBox(f'"{data["description"]}" has the same profile as "{existing[1]}" which is already in the library.\n\nYes to replace it, No to keep the existing holder, Cancel to add it anyway.',
+                                   'Duplicate Holder', adsk.core.MessageBoxButtonTypes.YesNoCancelButtonType)
+            action = {adsk.core.DialogResults.DialogYes: 'Replace Existing', adsk.core.DialogResults.DialogNo: 'Reuse Existing'}.get(answer, 'Add Anyway')
+        if existing is not None and action == 'Reuse Existing':
+            return 'reused'
+        self.library.add(Tool.createFromJson(json.dumps(data)))
+        if existing is not None and action == 'Replace Existing':
+            # new tools go on the end so the original positions stay good until finish removes them
+            self.replaced.append(existing[0])
+            self.index.remove(data)
+            self.index.add(data, self.library.count - 1)
+            return 'replaced'
+        self.index.add(data, self.library.count - 1)
+        return 'added'
+
+    def finish(self):
+        for position in sorted(self.replaced, reverse=True):
+            self.library.remove(position)
+        self.replaced = []
+
+def get_selected_library(inputs: adsk.core.CommandInputs) -> (adsk.core.URL, ToolLibrary, adsk.cam.ToolLibraries):
     # Get the selected library
     library_input: adsk.core.DropDownCommandInput = inputs.itemById('library')
     library = library_input.selectedItem.name
@@ -146,26 +248,219 @@ def command_execute(args: adsk.core.CommandEventArgs):
     camManager = adsk.cam.CAMManager.get()
     libraryManager = camManager.libraryManager
     toolLibraries = libraryManager.toolLibraries
-    library = toolLibraries.toolLibraryAtURL(library_url)
-    library.add(tool)
-    success = toolLibraries.updateToolLibrary(library_url, library)
-    if success:
-        futil.log('Tool added to library successfully')
-        ui.messageBox('Tool added to library successfully')
+    return library_url, toolLibraries.toolLibraryAtURL(library_url), toolLibraries
+
+def add_holders_batch(inputs: adsk.core.CommandInputs):
+    # Every selected body or component becomes its own holder, they are all added to the library and written back once
+    body_input: adsk.core.SelectionCommandInput = inputs.itemById('body')
+    prodvendor = inputs.itemById('prodvendor').value
+    library_url, library, toolLibraries = get_selected_library(inputs)
+    adder = HolderAdder(library)
+    summary = []
+    failures = 0
+    added = 0
+    for i in range(body_input.selectionCount):
+        start = time.time()
+        entity = body_input.selection(i).entity
+        if isinstance(entity, adsk.fusion.Occurrence):
+            name = entity.component.name
+            bodies = get_occurrence_bodies(entity)
+        else:
+            name = entity.name
+            bodies = [entity]
+        try:
+            axis, end_point = infer_axis(bodies)
+            if axis is None:
+                raise ValueError('could not find an axis of rotation')
+            tool_profile = get_tool_profile(bodies, axis, end_point)
+            if len(tool_profile) == 0:
+                raise ValueError('no profile was found')
+            segment_count = len(tool_profile)
+            tool_profile = compact_tool_profile(tool_profile)
+            result = adder.add(catalog.holder_data(tool_profile, name, '', '', prodvendor))
+            if result != 'reused':
+                added += 1
+            summary.append(f'{name}: {result}, {len(tool_profile)} segments (from {segment_count}) in {time.time() - start:.2f}s')
+        except Exception as e:
+            failures += 1
+            summary.append(f'{name}: FAILED ({e}) after {time.time() - start:.2f}s')
+    start = time.time()
+    adder.finish()
+    success = added > 0 and toolLibraries.updateToolLibrary(library_url, library)
+    summary.append(f'Library updated in {time.time() - start:.2f}s' if success else 'Library was not updated')
+    message = f'Added {added} holders, {failures} failed\n' + '\n'.join(summary)
+    futil.log(message)
+    ui.messageBox(message)
+
+def add_holders_from_catalog(inputs: adsk.core.CommandInputs):
+    file_dialog = ui.createFileDialog()
+    file_dialog.title = 'Select a Holder Catalog'
+    file_dialog.filter = 'Holder Catalogs (*.csv *.json);;All Files (*.*)'
+    if file_dialog.showOpen() != adsk.core.DialogResults.DialogOK:
+        return
+    start = time.time()
+    library_url, library, toolLibraries = get_selected_library(inputs)
+    adder = HolderAdder(library)
+    added = 0
+    reused = 0
+    failures = []
+    for name, data, error in catalog.catalog_holder_data(file_dialog.filename):
+        if error is not None:
+            failures.append(f'{name} ({error})')
+            continue
+        try:
+            if adder.add(data) == 'reused':
+                reused += 1
+            else:
+                added += 1
+        except Exception as e:
+            failures.append(f'{name} ({e})')
+    adder.finish()
+    success = added > 0 and toolLibraries.updateToolLibrary(library_url, library)
+    message = f'Added {added} holders from the catalog in {time.time() - start:.2f}s, {reused} were already in the library'
+    if not success:
+        message += '\nThe library was not updated'
+    if failures:
+        message += f'\n{len(failures)} failed: ' + ', '.join(failures)
+    futil.log(message)
+    ui.messageBox(message)
+
+def infer_axis(bodies: List[adsk.fusion.BRepBody]) -> (adsk.core.InfiniteLine3D, adsk.core.Point3D):
+    # Cluster the axes of every turned face, the biggest group of faces that share an axis is the axis of the holder
+    axes = []
+    cylinders = []
+    planes = []
+    for body in bodies:
+        # meshes don't have any faces to get an axis from
+        if isinstance(body, adsk.fusion.MeshBody):
+            continue
+        for face in body.faces:
+            surface_type = face.geometry.surfaceType
+            if surface_type in [adsk.core.SurfaceTypes.CylinderSurfaceType, adsk.core.SurfaceTypes.ConeSurfaceType, adsk.core.SurfaceTypes.TorusSurfaceType]:
+                line = get_axis(face)
+                if line is not None:
+                    axes.append((line.origin.asArray(), line.direction.asArray(), face.area))
+                    if surface_type == adsk.core.SurfaceTypes.CylinderSurfaceType:
+                        cylinders.append(face)
+            elif surface_type == adsk.core.SurfaceTypes.PlaneSurfaceType:
+                planes.append(face)
+    origin, direction = holder_profile.dominant_axis(axes)
+    if origin is None:
+        return None, None
+    axis = adsk.core.InfiniteLine3D.create(adsk.core.Point3D.create(*origin), adsk.core.Vector3D.create(*direction))
+
+    def axial(point: adsk.core.Point3D) -> float:
+        p = point.asArray()
+        return sum((p[k] - origin[k]) * direction[k] for k in range(3))
+    # the ends of the holder are the planar faces square to the axis that are furthest out along it
+    ends = [axial(face.pointOnFace) for face in planes if adsk.core.Plane.cast(face.geometry).normal.isParallelTo(axis.direction)]
+    if len(ends) == 0:
+        ends = [axial(vertex.geometry) for body in bodies if isinstance(body, adsk.fusion.BRepBody) for vertex in body.vertices]
+    if len(ends) == 0:
+        return None, None
+    low, high = min(ends), max(ends)
+    # the flange is the biggest cylinder and it is at the spindle end, so the tool goes in the end furthest from it
+    end = low
+    on_axis = [face for face in cylinders if axis.isColinearTo(get_axis(face))]
+    if len(on_axis) > 0:
+        flange = max(on_axis, key=lambda face: adsk.core.Cylinder.cast(face.geometry).radius)
+        if axial(flange.pointOnFace) - low < high - axial(flange.pointOnFace):
+            end = high
+    end_point = adsk.core.Point3D.create(*[origin[k] + direction[k] * end for k in range(3)])
+    return axis, end_point
+
+def get_inferred_axis(inputs: adsk.core.CommandInputs) -> (adsk.core.InfiniteLine3D, adsk.core.Point3D):
+    # The inferred axis and end for the selected bodies, only worked out again when the bodies change
+    body_input: adsk.core.SelectionCommandInput = inputs.itemById('body')
+    key = tuple(body_input.selection(i).entity.entityToken for i in range(body_input.selectionCount))
+    if key not in _inferred_axes:
+        _inferred_axes.clear()
+        _inferred_axes[key] = infer_axis(get_holder_bodies(body_input)) if len(key) > 0 else (None, None)
+    return _inferred_axes[key]
+
+def get_axis_and_end(inputs: adsk.core.CommandInputs) -> (adsk.core.InfiniteLine3D, adsk.core.Point3D):
+    # The selected axis and end face override the inferred ones
+    axis, end_point = get_inferred_axis(inputs)
+    if len(axis_tracker) > 0:
+        axis = axis_tracker.first()
+    end_face_input: adsk.core.SelectionCommandInput = inputs.itemById('end_face')
+    if axis is not None and end_face_input.selectionCount > 0:
+        end_point = is_valid_axial_datum(end_face_input.selection(0).entity, axis)
+    elif len(axis_tracker) > 0 and end_point is not None:
+        # the inferred end is still good on a hand picked axis, we just need it on the new line
+        end_point = adsk.core.Plane.create(end_point, axis.direction).intersectWithLine(axis)
+    return axis, end_point
     
 
 # This function will be called when the command needs to compute a new preview in the graphics window
 def command_preview(args: adsk.core.CommandEventArgs):
     inputs = args.command.commandInputs
+    clear_preview()
+    if inputs.itemById('catalog').value or inputs.itemById('batch').value:
+        return
+    cached = get_cached_profile(inputs)
+    if cached is None or len(cached[1]) == 0:
+        return
+    preview_profile(cached[1], cached[2], cached[3])
+
+def profile_key(inputs: adsk.core.CommandInputs):
+    # Everything the profile depends on, or None if there are no bodies yet, the axis and end are inferred if they aren't picked
+    body_input: adsk.core.SelectionCommandInput = inputs.itemById('body')
+    end_face_input: adsk.core.SelectionCommandInput = inputs.itemById('end_face')
+    if body_input.selectionCount == 0:
+        return None
+    body_tokens = tuple(body_input.selection(i).entity.entityToken for i in range(body_input.selectionCount))
+    axis_token = axis_tracker.tokens[0] if len(axis_tracker) > 0 else 'inferred'
+    end_token = end_face_input.selection(0).entity.entityToken if end_face_input.selectionCount > 0 else 'inferred'
+    return body_tokens, axis_token, end_token
+
+def get_cached_profile(inputs: adsk.core.CommandInputs):
+    # Returns (segment count before compaction, compacted profile, end point, direction towards the holder)
+    key = profile_key(inputs)
+    if key is None:
+        return None
+    if key in _profile_cache:
+        return _profile_cache[key]
+    bodies = get_holder_bodies(inputs.itemById('body'))
+    axis, end_point = get_axis_and_end(inputs)
+    if axis is None or end_point is None:
+        return None
+    tool_profile = get_tool_profile(bodies, axis, end_point)
+    # the profile only has distances along the axis so we need to know which side of the end the holder is on to draw it
+    direction = axis.direction
+    box = bodies[0].boundingBox
+    center = adsk.core.Point3D.create((box.minPoint.x + box.maxPoint.x) / 2, (box.minPoint.y + box.maxPoint.y) / 2, (box.minPoint.z + box.maxPoint.z) / 2)
+    if end_point.vectorTo(center).dotProduct(direction) < 0:
+        direction = direction.copy()
+        direction.scaleBy(-1)
+    _profile_cache[key] = (len(tool_profile), compact_tool_profile(tool_profile), end_point, direction)
+    return _profile_cache[key]
+
+def preview_profile(tool_profile: List[List[float]], end_point: adsk.core.Point3D, direction: adsk.core.Vector3D):
+    # Lines are much lighter than building a revolved body so this stays quick as the inputs change
+    global _preview_group
+    design = adsk.fusion.Design.cast(app.activeProduct)
+    _preview_group = design.rootComponent.customGraphicsGroups.add()
+    coordinates = adsk.fusion.CustomGraphicsCoordinates.create(holder_profile.revolved_lines(tool_profile, end_point.asArray(), direction.asArray()))
+    lines = _preview_group.addLines(coordinates, [], False)
+    lines.color = adsk.fusion.CustomGraphicsSolidColorEffect.create(adsk.core.Color.create(0, 160, 255, 255))
+    lines.weight = 2
+    lines.isSelectable = False
+
+def clear_preview():
+    global _preview_group
+    if _preview_group is not None and _preview_group.isValid:
+        _preview_group.deleteMe()
+    _preview_group = None
 
 def command_preselect(args: adsk.core.SelectionEventArgs):
     # if the user is selecting the end face then we need to check to see if the axis is valid
-    inputs = args.activeInput.parentCommand.commandInputs # APIDUMB: this is hacky and dumb, you should not have to walk this far through the object tree to get the command inputs
     if args.activeInput.id == 'end_face':
-        axis_input: adsk.core.SelectionCommandInput = inputs.itemById('axis')
-        axis = get_axis(axis_input.selection(0).entity)
+        axis = axis_tracker.first()
+        if axis is None:
+            axis = get_inferred_axis(args.activeInput.parentCommand.commandInputs)[0]
         end_face = args.selection.entity
-        if is_valid_axial_datum(end_face, axis) is None:
+        if axis is None or is_valid_axial_datum(end_face, axis) is None:
             args.isSelectable = False
 
 
@@ -175,29 +470,40 @@ def command_input_changed(args: adsk.core.InputChangedEventArgs):
     inputs = args.inputs
     axis_input: adsk.core.SelectionCommandInput = inputs.itemById('axis')
     end_face_input: adsk.core.SelectionCommandInput = inputs.itemById('end_face')
-    # only make the axis and end face inputs visible if the body input has been set
-    if changed_input.id == 'body' and changed_input.selectionCount > 0:
-        axis_input.isVisible = True
-        axis_input.isEnabled = True
-    elif changed_input.id == 'body':
-        axis_input.isVisible = False
-        end_face_input.isVisible = False
+    body_input: adsk.core.SelectionCommandInput = inputs.itemById('body')
+    # in batch mode the axis and end are found for each holder so we don't ask for them, or for a single name
+    batch = inputs.itemById('batch').value
+    catalog_mode = inputs.itemById('catalog').value
+    if changed_input.id == 'catalog':
+        # a catalog doesn't need any geometry at all
+        body_input.setSelectionLimits(0 if catalog_mode else 1, 0)
+        for input_id in ['body', 'batch', 'name', 'prodid', 'prodlink', 'prodvendor']:
+            inputs.itemById(input_id).isVisible = not catalog_mode
+    if changed_input.id == 'batch':
+        for input_id in ['name', 'prodid', 'prodlink']:
+            inputs.itemById(input_id).isVisible = not batch
+    # the axis and end are inferred as soon as there are bodies, they only need picking to override that
+    if changed_input.id == 'body' and changed_input.selectionCount == 0:
         axis_input.clearSelection()
-        end_face_input.clearSelection() 
+        end_face_input.clearSelection()
+        axis_tracker.clear()
+    axis_input.isVisible = not catalog_mode and not batch and body_input.selectionCount > 0
+    end_face_input.isVisible = axis_input.isVisible
 
-    if changed_input.id == 'axis' and changed_input.selectionCount > 0:
+    if changed_input.id == 'axis':
+        axis_tracker.update(changed_input)
+        # the end face has to be square to the axis so it has to be picked again
         if end_face_input.selectionCount > 0:
-            end_face_input.clearSelection() 
-        end_face_input.isVisible = True
-        end_face_input.isEnabled = True
-    elif changed_input.id == 'axis':
-        end_face_input.isVisible = False
-        end_face_input.clearSelection()
+            end_face_input.clearSelection()
 
 # This event handler is called when the command terminates.
 def command_destroy(args: adsk.core.CommandEventArgs):
     global local_handlers
     local_handlers = []
+    axis_tracker.clear()
+    _profile_cache.clear()
+    _inferred_axes.clear()
+    clear_preview()
     futil.log(f'{CMD_NAME} Command Destroy Event')
 
 def get_axis(axis_base: adsk.core.Base) -> adsk.core.InfiniteLine3D:
@@ -283,22 +589,70 @@ def is_valid_axial_datum(surface: adsk.core.Base, axis: adsk.core.InfiniteLine3D
         return plane.intersectWithLine(axis)
     return None
 
-def get_tool_profile(body: adsk.fusion.BRepBody, axis: adsk.core.InfiniteLine3D, plane_intersect: adsk.core.Point3D):
-    # first step is to get the axis 
-    # We will find Find all the points in the body and transform them all to cylindrical coordinates with the axis as the z axis
-    # then we will find the most negative z value and start working our way up the z axis
+def get_holder_bodies(body_input: adsk.core.SelectionCommandInput) -> List[adsk.fusion.BRepBody]:
+    # Flatten the selected bodies and components into a list of bodies
+    bodies = []
+    for i in range(body_input.selectionCount):
+        entity = body_input.selection(i).entity
+        if isinstance(entity, adsk.fusion.Occurrence):
+            bodies.extend(get_occurrence_bodies(entity))
+        else:
+            bodies.append(entity)
+    return bodies
+
+def get_occurrence_bodies(occurrence: adsk.fusion.Occurrence) -> List[adsk.fusion.BRepBody]:
+    bodies = [body for body in occurrence.bRepBodies if body.isSolid] + list(occurrence.meshBodies)
+    for child in occurrence.childOccurrences:
+        bodies.extend(get_occurrence_bodies(child))
+    return bodies
+
+def get_tool_profile(bodies: List[adsk.fusion.BRepBody], axis: adsk.core.InfiniteLine3D, plane_intersect: adsk.core.Point3D):
+    # Each body is only extracted once, then all of the segments go into one envelope so the outside of the whole assembly is what we get
+    settings = shared_state.load_settings(CMD_ID)
+    extraction = settings["extraction"]["default"]
+    face_segments = []
+    for body in bodies:
+        # analytic faces give an exact profile, anything else like splines, threads or meshes comes from the tessellation
+        # mesh bodies don't have any faces so they are always tessellated
+        if extraction == 'Tessellated' or isinstance(body, adsk.fusion.MeshBody) or (extraction == 'Automatic' and needs_tessellation(body)):
+            face_segments.extend(get_mesh_segments(body, axis, plane_intersect))
+        else:
+            face_segments.extend(get_body_segments(body, axis, plane_intersect))
+    # the outside of the holder is the upper envelope of all the segments, anything underneath it is hidden
+    profile_points = holder_profile.upper_envelope(face_segments)
+    return profile_points
+
+def compact_tool_profile(tool_profile: List[List[float]]) -> List[List[float]]:
+    # Finely detailed or tessellated models make hundreds of tiny segments, merge the ones that are nearly in line
+    tolerance = float(shared_state.load_settings(CMD_ID)["profile_tolerance"]["default"]) / 10 # mm to cm
+    compacted = holder_profile.compact_profile(tool_profile, tolerance)
+    futil.log(f'Compacted the profile from {len(tool_profile)} to {len(compacted)} segments')
+    return compacted
+
+def needs_tessellation(body) -> bool:
+    if isinstance(body, adsk.fusion.MeshBody):
+        return True
+    analytic = [adsk.core.SurfaceTypes.PlaneSurfaceType, adsk.core.SurfaceTypes.CylinderSurfaceType, adsk.core.SurfaceTypes.ConeSurfaceType, adsk.core.SurfaceTypes.TorusSurfaceType]
+    return any(face.geometry.surfaceType not in analytic for face in body.faces)
+
+def get_mesh_segments(body, axis: adsk.core.InfiniteLine3D, plane_intersect: adsk.core.Point3D):
+    # Mesh bodies already have a triangle mesh, BRep bodies get tessellated by their mesh manager
+    if isinstance(body, adsk.fusion.MeshBody):
+        mesh = body.displayMesh
+    else:
+        calculator = body.meshManager.createMeshCalculator()
+        calculator.setQuality(adsk.fusion.TriangleMeshQualityOptions.HighQualityTriangleMesh)
+        mesh = calculator.calculate()
+    coordinates = mesh.nodeCoordinatesAsDouble
+    points = list(zip(coordinates[0::3], coordinates[1::3], coordinates[2::3]))
+    cylindrical_points = holder_profile.project_points(points, plane_intersect.asArray(), axis.direction.asArray())
+    # every triangle edge is a piece of the surface so the envelope of the edges is the outside of the body
+    return holder_profile.mesh_edge_segments(cylindrical_points, mesh.nodeIndices)
+
+def get_body_segments(body: adsk.fusion.BRepBody, axis: adsk.core.InfiniteLine3D, plane_intersect: adsk.core.Point3D):
+    # the edges of the faces are measured from the plane through the end datum square to the axis
     plane = adsk.core.Plane.create(plane_intersect, axis.direction)
-    points = []
-    for edge in body.edges:
-        points.append(edge.startVertex.geometry)
-        points.append(edge.endVertex.geometry)
-    # now we have a list of all the points in the body
-    cylindrical_points = []
-    for point in points:
-        cylindrical_points.append(get_cylindrical_coordinates_point(point, axis, plane))
-    # now we need to find the most negative z value and start working our way up the z axis
-    # we will find the index of the most negative z value
-    
+
     # we will try and find conical, cylindrical and toroidal faces that are parallel to the axis
     # we can disregard planar faces because that are be parallel to the axis because they are inherent to the geometry
     # if we find a toroidal face we will pretend it is a chamfer, ie conical
@@ -339,66 +693,7 @@ def get_tool_profile(body: adsk.fusion.BRepBody, axis: adsk.core.InfiniteLine3D,
             r_1 = valid_edges[0][0]
             r_2 = valid_edges[-1][0]
             face_segments.append((r_1, r_2, z_1, z_2))
-    
-    ind_to_pop = []
-    face_segments.sort(key=lambda x: x[2])
-    for i in range(0, len(face_segments) - 1):
-        if abs(face_segments[i][0] - face_segments[i+1][0]) < 1e-8 and abs(face_segments[i][1] - face_segments[i+1][1]) < 1e-8 and abs(face_segments[i][2] - face_segments[i+1][2]) < 1e-8 and abs(face_segments[i][3] - face_segments[i+1][3]) < 1e-8:
-            ind_to_pop.append(i)
-    for i in range(0, len(ind_to_pop)):
-        face_segments.pop(ind_to_pop[i] - i)
-    # remove duplicates from the face segments
-    profile = []
-    for seg in face_segments:
-        profile.append((seg[0], seg[2], 1))
-        profile.append((seg[1], seg[3], 0))
-    profile.sort(key=lambda x: x[1])
-    # if there is more than 2 points in the profile with the same z value than we need to take only the two points with the largest r value
-    # this can cause a lot of issues with tools designed where radii are not are the same and similar strange issues
-    profile = filter_points(profile)
-
-    for segment in face_segments:
-        ind_to_pop = []
-        for i in range(0, len(profile)):
-            if profile[i][1] >= segment[3] - 1e-8 or profile[i][1] <= segment[2] + 1e-8:
-                continue
-            elif profile[i][0] < ((segment[1] - segment[0]) / (segment[3] - segment[2])) * (segment[2] - profile[i][1]) + segment[0]:
-                ind_to_pop.append(i)
-        for i in range(0, len(ind_to_pop)):
-            profile.pop(ind_to_pop[i] - i)
-
-    profile_points = []
-    # make it a profile
-    for i in range(0, len(profile) - 1):
-        if abs(profile[i][1] - profile[i+1][1]) < 1e-8:
-            continue
-        profile_points.append([profile[i][1], profile[i+1][1], profile[i][0], profile[i+1][0]])
-
-    return profile_points
-
-def filter_points(points):
-    # Create a dictionary to group points by their y values within 1e-8
-    grouped_points = {}
-    for x, y, z in points:
-        # Round y to 8 decimal places to consider y values within 1e-8
-        rounded_y = round(y, 8)
-        if rounded_y not in grouped_points:
-            grouped_points[rounded_y] = []
-        grouped_points[rounded_y].append((x, y, z))
-    
-    # Filter the groups and keep only the two points with the largest x values
-    # if this is the point with the lowest y value than we will only keep one point
-    filtered_points = []
-    min_key = min(grouped_points.keys())
-    for key, group in grouped_points.items():
-        sorted_group = sorted(group, key=lambda p: p[0], reverse=True)
-        if key == min_key:
-            filtered_points.append(sorted_group[0])
-        else:
-            filtered_points.extend(sorted_group[:2])
-    # now resort the points by their y values and their z values
-    filtered_points.sort(key=lambda p: (p[1], p[2]))
-    return filtered_points
+    return face_segments
 
 def get_cylindrical_coordinates_edge(edge: adsk.fusion.BRepEdge, axis: adsk.core.InfiniteLine3D, plane: adsk.core.Plane):
     # we only care if this edge is a arc or a circle
@@ -418,17 +713,6 @@ def get_cylindrical_coordinates_edge(edge: adsk.fusion.BRepEdge, axis: adsk.core
     z = point.distanceTo(intersect)
     return (edge.geometry.radius, z)
 
-def get_cylindrical_coordinates_point(point: adsk.core.Point3D, axis: adsk.core.InfiniteLine3D, plane: adsk.core.Plane) -> (float, float):
-    # get a infinite line through the point that is parallel to the axis
-    line = adsk.core.InfiniteLine3D.create(point, axis.direction)
-    # get the point where the line intersects the plane
-    intersect = plane.intersectWithLine(line)
-    # get the distance between the point and the intersection point
-    z = point.distanceTo(intersect)
-    # get the distance between the point and the axis
-    r = point.distanceTo(axis.origin)
-    return (r, z)
-
 def get_tooling_libraries() -> List:
     # Get the list of tooling libraries
     camManager = adsk.cam.CAMManager.get()
@@ -458,27 +742,3 @@ def format_library_names(libraries: List) -> List:
     for library in libraries:
         formatted_libraries.append(library.split('/')[-1])
     return formatted_libraries
-
-def generate_tool(profile, desc, prodid, prodlink, prodvendor) -> Tool:
-    guid = "00000000-0000-0000-0000-" + str(random.randint(100000000000,999999999999))
-    data = {
-        "description": desc,
-        "guid": guid,
-        "last_modified": math.ceil(time.time()),
-        "product-id": prodid,
-        "product-link": prodlink,
-        "reference_guid": guid,
-        "segments": [],
-        "type": "holder",
-        "unit": "millimeters",
-        "vendor": prodvendor,
-    }
-    
-    for segment in profile:
-        seg = {
-            "height": round((segment[1] - segment[0])*10, 3),
-            "lower-diameter": round(segment[2]*10*2, 3),
-            "upper-diameter": round(segment[3]*10*2, 3)
-        }
-        data["segments"].append(seg)
-    return Tool.createFromJson(json.dumps(data))
\ No newline at end of file
@@ -0,0 +1,240 @@
+#  Copyright 2023 by Ian Rist
+
+# Geometry helpers for turning a holder into a radius profile along its axis.
+# Points are plain (x, y, z) tuples in cm and profiles are [z_1, z_2, r_1, r_2] lists, the same as generate_tool takes.
+
+from typing import List, Tuple
+import heapq
+import math
+
+Point = Tuple[float, float, float]
+
+def project_points(points: List[Point], origin: Point, direction: Point) -> List[Tuple[float, float]]:
+    ''' Returns (r, z) for every point, r is the distance to the axis line and z is the distance along the axis from origin '''
+    length = math.sqrt(direction[0]**2 + direction[1]**2 + direction[2]**2)
+    dx, dy, dz = direction[0] / length, direction[1] / length, direction[2] / length
+    ox, oy, oz = origin
+    cylindrical = []
+    for x, y, z in points:
+        vx, vy, vz = x - ox, y - oy, z - oz
+        axial = vx*dx + vy*dy + vz*dz
+        # what is left after taking out the axial part is the radial part
+        rx, ry, rz = vx - axial*dx, vy - axial*dy, vz - axial*dz
+        # we keep z unsigned to match get_cylindrical_coordinates_edge
+        cylindrical.append((math.sqrt(rx*rx + ry*ry + rz*rz), abs(axial)))
+    return cylindrical
+
+class _Line:
+    # r = slope * z + intercept over z_1 to z_2
+    def __init__(self, r_1, r_2, z_1, z_2):
+        if z_2 < z_1:
+            r_1, r_2, z_1, z_2 = r_2, r_1, z_2, z_1
+        self.z_1 = z_1
+        self.z_2 = z_2
+        self.slope = (r_2 - r_1) / (z_2 - z_1)
+        self.intercept = r_1 - self.slope * z_1
+
+    def at(self, z: float) -> float:
+        return self.slope * z + self.intercept
+
+def upper_envelope(segments: List[Tuple[float, float, float, float]], tol: float = 1e-8) -> List[List[float]]:
+    ''' Computes the outer radius r(z) of a set of (r_1, r_2, z_1, z_2) segments from cylindrical and conical faces or mesh edges.
+    Returns the profile as [z_1, z_2, r_1, r_2] segments sorted along the axis, which is what generate_tool takes.
+    The envelope is built by splitting the segments in half, building the envelope of each half and merging the two,
+    a merge is one pass along both envelopes so the whole thing is O(n log n) as an envelope of n segments has O(n) pieces. '''
+    lines = [_Line(*segment) for segment in segments if abs(segment[3] - segment[2]) > tol]
+    if len(lines) == 0:
+        return []
+    # sorted along the axis each half covers less of it, so the envelopes being merged stay short
+    lines.sort(key=lambda line: line.z_1)
+    pieces = _envelope(lines, 0, len(lines), tol)
+
+    # join up the pieces that are on the same line and bridge any gaps along the axis
+    profile = []
+    for z_a, z_b, index in pieces:
+        line = lines[index]
+        if profile and profile[-1][4] == index and abs(profile[-1][1] - z_a) <= tol:
+            profile[-1][1] = z_b
+            profile[-1][3] = line.at(z_b)
+            continue
+        if profile and z_a - profile[-1][1] > tol:
+            profile.append([profile[-1][1], z_a, profile[-1][3], line.at(z_a), -1])
+        profile.append([z_a, z_b, line.at(z_a), line.at(z_b), index])
+    return [piece[:4] for piece in profile]
+
+def _envelope(lines: List[_Line], low: int, high: int, tol: float) -> List[Tuple[float, float, int]]:
+    # The envelope of lines[low:high] as (z_a, z_b, line index) pieces sorted along the axis, there can be gaps between them
+    if high - low == 1:
+        return [(lines[low].z_1, lines[low].z_2, low)]
+    middle = (low + high) // 2
+    return _merge_envelopes(lines, _envelope(lines, low, middle, tol), _envelope(lines, middle, high, tol), tol)
+
+def _merge_envelopes(lines: List[_Line], first: list, second: list, tol: float) -> List[Tuple[float, float, int]]:
+    # Sweep along both envelopes at once, at every point there is at most one piece from each so we only ever compare two lines
+    merged = []
+    i = j = 0
+    z = min(first[0][0], second[0][0])
+    while True:
+        # drop the pieces the sweep has already passed
+        while i < len(first) and first[i][1] <= z + tol:
+            i += 1
+        while j < len(second) and second[j][1] <= z + tol:
+            j += 1
+        a = first[i] if i < len(first) else None
+        b = second[j] if j < len(second) else None
+        if a is None and b is None:
+            return merged
+        a_on = a is not None and a[0] <= z + tol
+        b_on = b is not None and b[0] <= z + tol
+        if not a_on and not b_on:
+            # a gap in both, jump to whichever piece starts next
+            z = min(piece[0] for piece in (a, b) if piece is not None)
+            continue
+        # the next place something changes is where a piece ends or the other envelope starts again
+        end = min(piece[1] if on else piece[0] for piece, on in ((a, a_on), (b, b_on)) if piece is not None)
+        if a_on and b_on:
+            line_a, line_b = lines[a[2]], lines[b[2]]
+            d_start = line_a.at(z) - line_b.at(z)
+            d_end = line_a.at(end) - line_b.at(end)
+            crossing = z + (end - z) * d_start / (d_start - d_end) if (d_start > tol and d_end < -tol) or (d_start < -tol and d_end > tol) else None
+            if crossing is not None and crossing - z > tol and end - crossing > tol:
+                _add_piece(merged, z, crossing, a[2] if d_start > 0 else b[2], tol)
+                _add_piece(merged, crossing, end, b[2] if d_start > 0 else a[2], tol)
+            else:
+                _add_piece(merged, z, end, a[2] if d_start + d_end >= 0 else b[2], tol)
+        else:
+            _add_piece(merged, z, end, (a if a_on else b)[2], tol)
+        z = end
+
+def _add_piece(pieces: list, z_a: float, z_b: float, index: int, tol: float):
+    # carry on the last piece if it is the same line so the envelopes don't grow with every merge
+    if pieces and pieces[-1][2] == index and abs(pieces[-1][1] - z_a) <= tol:
+        pieces[-1] = (pieces[-1][0], z_b, index)
+    else:
+        pieces.append((z_a, z_b, index))
+
+def compact_profile(profile: List[List[float]], tol: float) -> List[List[float]]:
+    ''' Merges runs of collinear and nearly collinear [z_1, z_2, r_1, r_2] segments into single segments.
+    A run is replaced by the chord between its ends, lifted just enough to clear every vertex in the run,
+    as long as no vertex, the two ends included, ends up more than tol below it. That way the compacted profile
+    is never inside the original envelope and never more than tol outside it.
+    Steps in radius between segments are kept as they are. '''
+    if len(profile) < 2:
+        return [segment[:] for segment in profile]
+    compacted = []
+    start = 0
+    while start < len(profile):
+        z_0, r_0 = profile[start][0], profile[start][2]
+        end = start
+        lift = 0.0
+        # the vertices furthest above and below any chord are on the upper and lower hulls of the run,
+        # so those are all we keep and each step is a bisection instead of a pass over the whole run
+        upper, lower = [], []
+        # keep growing the run while the lifted chord to the end of the next segment stays within tol of every vertex
+        while end + 1 < len(profile) and abs(profile[end + 1][2] - profile[end][3]) <= 1e-9 and abs(profile[end + 1][0] - profile[end][1]) <= 1e-9:
+            _hull_add(upper, (profile[end][1], profile[end][3]), 1)
+            _hull_add(lower, (profile[end][1], profile[end][3]), -1)
+            z_n, r_n = profile[end + 1][1], profile[end + 1][3]
+            slope = (r_n - r_0) / (z_n - z_0)
+            below = _hull_extreme(upper, slope, 1) - r_0 + slope * z_0
+            above = _hull_extreme(lower, slope, -1) + r_0 - slope * z_0
+            run_lift = max(0.0, below)
+            # the ends of the run sit exactly on the chord so they are lifted by run_lift too
+            if max(0.0, above) + run_lift > tol:
+                break
+            lift = run_lift
+            end += 1
+        compacted.append([z_0, profile[end][1], r_0 + lift, profile[end][3] + lift])
+        start = end + 1
+    return compacted
+
+def revolved_lines(profile: List[List[float]], origin: Point, direction: Point, sides: int = 36, spokes: int = 4) -> List[float]:
+    ''' Flat [x, y, z, x, y, z, ...] coordinates of line pairs outlining the profile revolved around the axis.
+    There is a ring at the ends of every segment and the profile itself is drawn at a few angles around the axis. '''
+    length = math.sqrt(direction[0]**2 + direction[1]**2 + direction[2]**2)
+    d = [direction[0] / length, direction[1] / length, direction[2] / length]
+    # any vector that isn't parallel to the axis gives us the two radial directions
+    helper = [1.0, 0.0, 0.0] if abs(d[0]) < 0.9 else [0.0, 1.0, 0.0]
+    u = [d[1]*helper[2] - d[2]*helper[1], d[2]*helper[0] - d[0]*helper[2], d[0]*helper[1] - d[1]*helper[0]]
+    u_length = math.sqrt(u[0]**2 + u[1]**2 + u[2]**2)
+    u = [c / u_length for c in u]
+    v = [d[1]*u[2] - d[2]*u[1], d[2]*u[0] - d[0]*u[2], d[0]*u[1] - d[1]*u[0]]
+
+    def point(z, r, angle):
+        c, s = r * math.cos(angle), r * math.sin(angle)
+        return [origin[i] + d[i]*z + u[i]*c + v[i]*s for i in range(3)]
+
+    coordinates = []
+    rings = set()
+    for z_1, z_2, r_1, r_2 in profile:
+        rings.add((round(z_1, 9), round(r_1, 9)))
+        rings.add((round(z_2, 9), round(r_2, 9)))
+        for k in range(spokes):
+            angle = 2 * math.pi * k / spokes
+            coordinates += point(z_1, r_1, angle) + point(z_2, r_2, angle)
+    for z, r in rings:
+        for k in range(sides):
+            coordinates += point(z, r, 2 * math.pi * k / sides) + point(z, r, 2 * math.pi * (k + 1) / sides)
+    return coordinates
+
+def dominant_axis(axes: List[Tuple[Point, Point, float]], angle_tol: float = 1e-6, distance_tol: float = 1e-3) -> Tuple[Point, Point]:
+    ''' Groups (origin, direction, weight) axes into clusters of colinear axes and returns (origin, unit direction) of the heaviest cluster.
+    The heaviest axes go first so each cluster is represented by its biggest face, there are only ever a few clusters
+    on a holder so checking every axis against every cluster is still a single pass in practice. '''
+    clusters = []
+    for origin, direction, weight in sorted(axes, key=lambda axis: -axis[2]):
+        length = math.sqrt(direction[0]**2 + direction[1]**2 + direction[2]**2)
+        d = (direction[0] / length, direction[1] / length, direction[2] / length)
+        for cluster in clusters:
+            c_origin, c_d = cluster[0], cluster[1]
+            if 1 - abs(d[0]*c_d[0] + d[1]*c_d[1] + d[2]*c_d[2]) > angle_tol:
+                continue
+            # the distance from this origin to the cluster's line
+            v = (origin[0] - c_origin[0], origin[1] - c_origin[1], origin[2] - c_origin[2])
+            along = v[0]*c_d[0] + v[1]*c_d[1] + v[2]*c_d[2]
+            if math.sqrt(max(v[0]**2 + v[1]**2 + v[2]**2 - along*along, 0.0)) > distance_tol:
+                continue
+            cluster[2] += weight
+            break
+        else:
+            clusters.append([origin, d, weight])
+    if len(clusters) == 0:
+        return None, None
+    best = max(clusters, key=lambda cluster: cluster[2])
+    return best[0], best[1]
+
+def mesh_edge_segments(cylindrical_points: List[Tuple[float, float]], node_indices: List[int]) -> List[Tuple[float, float, float, float]]:
+    ''' Turns the edges of a triangle mesh into (r_1, r_2, z_1, z_2) segments, node_indices is three nodes per triangle.
+    Edges shared by two triangles are only kept once, the segments can go into upper_envelope with any others. '''
+    edges = set()
+    for k in range(0, len(node_indices) - 2, 3):
+        a, b, c = node_indices[k], node_indices[k + 1], node_indices[k + 2]
+        for i, j in ((a, b), (b, c), (c, a)):
+            edges.add((i, j) if i < j else (j, i))
+    segments = []
+    for i, j in edges:
+        (r_1, z_1), (r_2, z_2) = cylindrical_points[i], cylindrical_points[j]
+        segments.append((r_1, r_2, z_1, z_2))
+    return segments
+
+def _hull_add(hull: List[Tuple[float, float]], point: Tuple[float, float], sign: int):
+    # Monotone chain for (z, r) points that come in order along z, sign 1 keeps the upper hull and -1 the lower one
+    while len(hull) >= 2:
+        (z_1, r_1), (z_2, r_2) = hull[-2], hull[-1]
+        if sign * ((z_2 - z_1) * (point[1] - r_1) - (r_2 - r_1) * (point[0] - z_1)) < 0:
+            break
+        hull.pop()
+    hull.append(point)
+
+def _hull_extreme(hull: List[Tuple[float, float]], slope: float, sign: int) -> float:
+    # The largest sign * (r - slope * z) of any point on the hull, it rises along the hull until the edges are flatter than slope
+    low, high = 0, len(hull) - 1
+    while low < high:
+        middle = (low + high) // 2
+        (z_1, r_1), (z_2, r_2) = hull[middle], hull[middle + 1]
+        if sign * ((r_2 - r_1) - slope * (z_2 - z_1)) > 0:
+            low = middle + 1
+        else:
+            high = middle
+    z, r = hull[low]
+    return sign * (r - slope * z)
@@ -4,6 +4,8 @@ from ...lib import fusion360utils as futil
 from ... import config
 from ... import shared_state
 from ...timer import Timer, format_timer
+from ...selection_tracker import SelectionTracker
+from . import surface_fit
 from typing import List, Dict
 import math
 
@@ -32,6 +34,23 @@ DEFAULT_SETTINGS = {
         "type": "checkbox",
         "label": "Permissive Tangency Mode",
         "default": False
+    },
+    "expand_chains": {
+        "type": "checkbox",
+        "label": "Expand Picked Faces to Their Whole Chamfer",
+        "default": False
+    },
+    "backend": {
+        "type": "dropdown",
+        "label": "Surface Backend",
+        "options": ["Loft", "Direct Fit"],
+        "default": "Loft"
+    },
+    "auto_max_width": {
+        "type": "dropdown",
+        "label": "Max Auto-detected Chamfer Width (mm)",
+        "options": ["0.5", "1", "2", "3", "5"],
+        "default": "2"
     }
 }
 
@@ -43,6 +62,15 @@ timer = Timer()
 # Local list of event handlers used to maintain a reference so
 # they are not released and garbage collected.
 local_handlers = []
+_preview_group: adsk.fusion.CustomGraphicsGroup = None
+# The fitted boundaries have to be well inside the 0.1 mm that sew_patches stitches at, in cm
+FIT_TOLERANCE = 0.005
+# Tracks the body of every selected face so we can group the faces by body without walking the whole selection
+chain_tracker = SelectionTracker(lambda face: (face.body.entityToken, face.body.parentComponent.entityToken))
+# The chamfer feature that made each face of a component keyed by component token, so finding the feature of a picked face is one lookup
+_feature_faces: Dict[str, Dict[str, adsk.fusion.ChamferFeature]] = {}
+# The faces and tangent neighbours of the features that faces were picked from, keyed by feature token and permissive mode, so each one is only worked out once while the command is open
+_feature_chains: Dict[tuple, tuple] = {}
 
 def start():
     cmd_def = ui.commandDefinitions.addButtonDefinition(CMD_ID, CMD_NAME, CMD_Description, ICON_FOLDER)
@@ -69,8 +97,11 @@ def command_created(args: adsk.core.CommandCreatedEventArgs):
     # General logging for debug.
     settings = shared_state.load_settings(CMD_ID)
     futil.log(f'{CMD_NAME} Command Created Event')
+    chain_tracker.clear()
+    _feature_faces.clear()
+    _feature_chains.clear()
     futil.add_handler(args.command.execute, command_execute, local_handlers=local_handlers)
-    # futil.add_handler(args.command.inputChanged, command_input_changed, local_handlers=local_handlers)
+    futil.add_handler(args.command.inputChanged, command_input_changed, local_handlers=local_handlers)
     futil.add_handler(args.command.validateInputs, command_validateinputs, local_handlers=local_handlers)
     futil.add_handler(args.command.executePreview, command_preview, local_handlers=local_handlers)
     futil.add_handler(args.command.preSelect, command_preselect, local_handlers=local_handlers)
@@ -82,7 +113,17 @@ def command_created(args: adsk.core.CommandCreatedEventArgs):
     # We need to allow only planar, cylindrical, and conical faces because those are the only ones
     # that will be from a valid chamfer and can be correctly patched.
     face_chain_input.selectionFilters = ['PlanarFaces', 'CylindricalFaces', 'ConicalFaces', 'SplineFaces']
-    face_chain_input.setSelectionLimits(1, 0)
+    face_chain_input.setSelectionLimits(0, 0)
+
+    # If the chamfer is still a feature in the timeline it already knows what faces make up each chain
+    feature_input = inputs.addSelectionInput('feature', 'Chamfer Features', 'Select chamfer features from the timeline to patch all of their faces.')
+    feature_input.selectionFilters = ['Features']
+    feature_input.setSelectionLimits(0, 0)
+
+    # Optionally the user can pick a whole body and we will find all of the chamfers on it for them
+    body_input = inputs.addSelectionInput('body', 'Auto-detect Bodies', 'Select the bodies to find and patch every chamfer on, this replaces the face selection.')
+    body_input.selectionFilters = ['SolidBodies']
+    body_input.setSelectionLimits(0, 0)
 
     # We need to give the user the option to wither create just a patch or splice it back into the model.
     # To do this we will create a radio group with two options.
@@ -90,126 +131,210 @@ def command_created(args: adsk.core.CommandCreatedEventArgs):
 
     permissive_input = inputs.addBoolValueInput('permissive', 'Permissive Mode', True, '', settings["permissive"]["default"])
 
+    # A face picked from a chamfer feature can take the rest of its chain with it, off by default so sewing only replaces the picked faces
+    expand_input = inputs.addBoolValueInput('expand', 'Whole Chamfer Chains', True, '', settings["expand_chains"]["default"])
+    expand_input.tooltip = 'Picking one face of a chamfer feature patches every face tangent to it in that feature.'
+
 def command_execute(args: adsk.core.CommandEventArgs):
     # General logging for debug
     futil.log(f'{CMD_NAME} Command Execute Event')
     inputs = args.command.commandInputs
-    patch_faces(inputs.itemById('chain'), inputs.itemById('sew_mode').value)
+    clear_preview()
+    patch_faces(get_chains(inputs), inputs.itemById('sew_mode').value)
 
 # This function will be called when the command needs to compute a new preview in the graphics window
 def command_preview(args: adsk.core.CommandEventArgs):
     inputs = args.command.commandInputs
-    patch_faces(inputs.itemById('chain'), False)
+    # The preview is built from temporary bodies and custom graphics so the timeline never has to recompute,
+    # the real loft, unstitch and stitch features are only made on execute
+    body_chains = get_chains(inputs)
+    preview_faces([chain for chains in body_chains.values() for chain in chains])
+
+def get_chains(inputs: adsk.core.CommandInputs) -> Dict[str, List[List[adsk.fusion.BRepFace]]]:
+    # Returns the chains of faces grouped by the entity token of the body they are on
+    timer.mark('find_chains')
+    permissive = inputs.itemById('permissive').value
+    body_chains: Dict[str, List[List[adsk.fusion.BRepFace]]] = {}
+    body_input: adsk.core.SelectionCommandInput = inputs.itemById('body')
+    if body_input.selectionCount > 0:
+        settings = shared_state.load_settings(CMD_ID)
+        max_width = float(settings["auto_max_width"]["default"]) / 10 # mm to cm
+        for i in range(body_input.selectionCount):
+            body = body_input.selection(i).entity
+            body_chains[body.entityToken] = find_chamfer_chains(body, max_width, permissive)
+        return body_chains
+    # chamfer features give us their chains directly
+    covered = set()
+    feature_input: adsk.core.SelectionCommandInput = inputs.itemById('feature')
+    for i in range(feature_input.selectionCount):
+        timer.mark('find_chains:feature')
+        for chain in chamfer_feature_chains(feature_input.selection(i).entity, permissive):
+            add_feature_chain(body_chains, covered, chain)
+
+    chain_selection: adsk.core.SelectionCommandInput = inputs.itemById('chain')
+    chain_tracker.update(chain_selection)
+    if chain_selection.selectionCount == 0:
+        return body_chains
+    # if the selected faces came from a chamfer feature the feature already tells us which of them are tangent
+    # so we skip the tangency checks, only the faces that didn't come from one go through face_chain_finder
+    timer.mark('find_chains:feature_lookup')
+    body_faces: Dict[str, List[adsk.fusion.BRepFace]] = {}
+    # picked face tokens keyed the same way as _feature_chains
+    feature_picks: Dict[tuple, set] = {}
+    for i in range(chain_selection.selectionCount):
+        token = chain_tracker.tokens[i]
+        if token in covered:
+            continue
+        body_token, component_token = chain_tracker.values[i]
+        if component_token not in _feature_faces:
+            _feature_faces[component_token] = index_chamfer_features(chain_selection.selection(i).entity.body.parentComponent)
+        feature = _feature_faces[component_token].get(token)
+        if feature is None:
+            # a chain can never cross between bodies so we split the faces up by body before looking for chains
+            body_faces.setdefault(body_token, []).append(chain_selection.selection(i).entity)
+            continue
+        # only the features that faces were picked from get their tangency checked
+        key = (feature.entityToken, permissive)
+        if key not in _feature_chains:
+            _feature_chains[key] = chamfer_feature_graph(feature, permissive)
+        feature_picks.setdefault(key, set()).add(token)
+    expand = inputs.itemById('expand').value
+    for key, picked in feature_picks.items():
+        faces, tokens, neighbors = _feature_chains[key]
+        if expand:
+            # every chain with a picked face in it
+            for chain in connected_faces(faces, neighbors):
+                if any(face.entityToken in picked for face in chain):
+                    add_feature_chain(body_chains, covered, chain)
+        else:
+            # just the picked faces, split wherever they aren't tangent neighbours
+            for chain in connected_faces(faces, neighbors, {i for i, token in enumerate(tokens) if token in picked}):
+                add_feature_chain(body_chains, covered, chain)
+    for body_token, faces in body_faces.items():
+        body_chains.setdefault(body_token, []).extend(face_chain_finder(faces, permissive))
+    return body_chains
+
+def add_feature_chain(body_chains: Dict[str, List[List[adsk.fusion.BRepFace]]], covered: set, chain: List[adsk.fusion.BRepFace]):
+    tokens = [face.entityToken for face in chain]
+    if tokens[0] in covered:
+        return
+    covered.update(tokens)
+    body_chains.setdefault(chain[0].body.entityToken, []).append(chain)
+
+def chamfer_feature_chains(feature: adsk.fusion.ChamferFeature, permissive: bool = False) -> List[List[adsk.fusion.BRepFace]]:
+    faces, _, neighbors = chamfer_feature_graph(feature, permissive)
+    return connected_faces(faces, neighbors)
+
+def chamfer_feature_graph(feature: adsk.fusion.ChamferFeature, permissive: bool = False) -> (List[adsk.fusion.BRepFace], List[str], List[List[int]]):
+    # The faces of one chamfer feature that meet tangentially are the same chain, we only have to check the edges they share
+    # mitered corners like the top edges of a box share an edge without being tangent so they are split into separate chains
+    # returns the faces, their tokens and the indices of each face's tangent neighbours
+    faces = [face for face in feature.faces]
+    edge_faces: Dict[str, List[int]] = {}
+    edges: Dict[str, adsk.fusion.BRepEdge] = {}
+    for i, face in enumerate(faces):
+        for edge in face.edges:
+            edge_faces.setdefault(edge.entityToken, []).append(i)
+            edges[edge.entityToken] = edge
+    neighbors: List[List[int]] = [[] for _ in faces]
+    for token, indices in edge_faces.items():
+        if len(indices) != 2:
+            continue
+        a, b = indices
+        if are_faces_tangent(faces[a], faces[b], edges[token], permissive):
+            neighbors[a].append(b)
+            neighbors[b].append(a)
+    return faces, [face.entityToken for face in faces], neighbors
+
+def connected_faces(faces: List[adsk.fusion.BRepFace], neighbors: List[List[int]], keep: set = None) -> List[List[adsk.fusion.BRepFace]]:
+    # Group the faces into chains of neighbours, if keep is given only the faces with those indices are used
+    chains = []
+    visited = set()
+    for i in range(len(faces)):
+        if i in visited or (keep is not None and i not in keep):
+            continue
+        visited.add(i)
+        stack = [i]
+        chain = []
+        while stack:
+            current = stack.pop()
+            chain.append(faces[current])
+            for other in neighbors[current]:
+                if other not in visited and (keep is None or other in keep):
+                    visited.add(other)
+                    stack.append(other)
+        chains.append(chain)
+    return chains
+
+def index_chamfer_features(component: adsk.fusion.Component) -> Dict[str, adsk.fusion.ChamferFeature]:
+    # Map every face made by a chamfer feature in the component to its feature, this only reads the face tokens so it is cheap
+    face_features: Dict[str, adsk.fusion.ChamferFeature] = {}
+    for feature in component.features.chamferFeatures:
+        # suppressed or rolled back features don't have any faces in the model
+        if feature.isSuppressed or (feature.timelineObject is not None and feature.timelineObject.isRolledBack):
+            continue
+        for face in feature.faces:
+            face_features[face.entityToken] = feature
+    return face_features
 
 def command_validateinputs(args: adsk.core.ValidateInputsEventArgs):
-    # The only thing we are doing here is making sure that they are only selecting one body
+    # We need some faces, a chamfer feature or a body to search for chamfers
     chain_selection: adsk.core.SelectionCommandInput = args.inputs.itemById('chain')
-    if chain_selection.selectionCount > 1:
-        # we will make a dict of the bodies that are selected with the number of faces that are selected on that body
-        body_dict = {}
-        for i in range(chain_selection.selectionCount):
-            entityToken = chain_selection.selection(i).entity.body.entityToken
-            if entityToken in body_dict:
-                body_dict[entityToken] += 1
-            else:
-                body_dict[entityToken] = 1
-        # then we will check to see if there is more than one body in the dict
-        if len(body_dict) > 1:
-            # get all the faces we want, and then add them to the selection
-            # APIDUMB: There is no way to remove a selection from a selection command input but you can add to it and clear it
-            max_body = max(body_dict, key=body_dict.get)
-            good_faces = []
-            for i in range(chain_selection.selectionCount):
-                if chain_selection.selection(i).entity.body.entityToken == max_body:
-                    good_faces.append(chain_selection.selection(i).entity)
-            chain_selection.clearSelection()
-            for i in range(len(good_faces)):
-                chain_selection.addSelection(good_faces[i])
+    feature_input: adsk.core.SelectionCommandInput = args.inputs.itemById('feature')
+    body_input: adsk.core.SelectionCommandInput = args.inputs.itemById('body')
+    args.areInputsValid = chain_selection.selectionCount > 0 or feature_input.selectionCount > 0 or body_input.selectionCount > 0
 
 def command_preselect(args: adsk.core.SelectionEventArgs):
-    if args.activeInput.id == 'chain':
-        # if there are already faces selected then we have to make sure that the new selection is on the same body
-        # first if there are no faces selected then we will allow the selection
-        if args.activeInput.selectionCount == 0:
-            args.isSelectable = True
-        elif args.selection.entity is None:
-            pass
-        elif args.activeInput.selection(0).entity is None:
-            pass
-        elif args.activeInput.selection(0).entity.body == args.selection.entity.body:
-            args.isSelectable = True
-        else:
-            args.isSelectable = False
+    # only chamfer features can be picked from the timeline
+    if args.activeInput.id == 'feature' and args.selection.entity is not None:
+        args.isSelectable = args.selection.entity.objectType == adsk.fusion.ChamferFeature.classType()
 
 # This function will be called when the user changes anything in the command dialog
-# def command_input_changed(args: adsk.core.InputChangedEventArgs):
-#     changed_input = args.input
-#     inputs = args.inputs
-#     futil.log(f'{CMD_NAME} Input Changed Event fired from a change to {changed_input.id}')
-
-def patch_faces(selections: adsk.core.SelectionCommandInput, sew: bool):
-    timer.mark('find_chains')
-    tangent_faces = face_chain_finder(selections)
+def command_input_changed(args: adsk.core.InputChangedEventArgs):
+    changed_input = args.input
+    inputs = args.inputs
+    # the face and feature selections are ignored while a body is selected for auto-detection so we hide them
+    if changed_input.id == 'body':
+        inputs.itemById('chain').isVisible = changed_input.selectionCount == 0
+        inputs.itemById('feature').isVisible = changed_input.selectionCount == 0
+        inputs.itemById('expand').isVisible = changed_input.selectionCount == 0
+    elif changed_input.id == 'chain':
+        chain_tracker.update(changed_input)
+
+def patch_faces(body_chains: Dict[str, List[List[adsk.fusion.BRepFace]]], sew: bool):
     # first we will find the loop around the boundary of the faces
     product = adsk.fusion.Design.cast(app.activeProduct)
     active_comp = product.activeComponent
     features = active_comp.features
     firstTLN: adsk.fusion.TimelineObject = None
-    stitch_entities = adsk.core.ObjectCollection.create()
-    unstitch_entities = adsk.core.ObjectCollection.create()
-    faces_to_delete = []
-    facess = []
-    timer.mark('get_faces')
-    for i, tf in enumerate(tangent_faces):
-        timer.mark(f'get_faces:{i}')
-        facess.append(get_faces(tf, selections))
+    secondTLN: adsk.fusion.TimelineObject = None
     timer.mark('patch_faces')
-    for i, faces in enumerate(facess):
-        timer.mark(f'patch_faces:{i}')
-        if len(faces) == 1:
-            continue
-        body, tln1, tln2 = patcher(faces, features)
-        if firstTLN is None:
-            firstTLN = tln1
-        secondTLN = tln2
-        # If we are going to sew the patch into the model then we need to add it to the list of bodies to be deleted
-        stitch_entities.add(body)
-        if sew:
-            for j in range(len(faces)):
-                unstitch_entities.add(faces[j])
-                faces_to_delete.append(faces[j].entityToken)
-    
-    # if we are not going to sew then we are done
-    if sew:
-        # we know that all the faces are on the same body so we can just
-        # unstitch the body, get the parts of the unstitched body we want, and then delete the faces that are selected
-        # and then sew the body back together with the patch faces
-        
-        # now we will unstitch the body, by creating a unstitch feature
-        timer.mark('unstitch')
-        unstitch_features = active_comp.features.unstitchFeatures
-        unstitch = unstitch_features.add(unstitch_entities, False)
-        timer.mark('find_good_faces')
-        for i in range(unstitch.bodies.count):
-            # if this body has and faces in the list of faces to delete then we will not add it to the new body
-            if unstitch.bodies.item(i).faces.item(0).entityToken in faces_to_delete:
-                pass
-            else:
-                stitch_entities.add(unstitch.bodies.item(i))
-        # now we will delete the faces that are selected
-        timer.mark('delete_faces')
-        delete_features = active_comp.features.deleteFaceFeatures
-        delete_entities = adsk.core.ObjectCollection.create()
-        for i in range(len(faces_to_delete)):
-            ent_list = active_comp.parentDesign.findEntityByToken(faces_to_delete[i])
-            delete_entities.add(ent_list[0])
-        delete = delete_features.add(delete_entities)
-        # now we will sew the body back together
-        timer.mark('stitch')
-        stitch_features = active_comp.features.stitchFeatures
-        stitch_input = stitch_features.createInput(stitch_entities, adsk.core.ValueInput.createByString('0.1 mm'))
-        stitch = stitch_features.add(stitch_input)
-        secondTLN = stitch.timelineObject
+    # every body gets its own unstitch and stitch but they all end up in one timeline group
+    for b, facess in enumerate(body_chains.values()):
+        stitch_entities = adsk.core.ObjectCollection.create()
+        unstitch_entities = adsk.core.ObjectCollection.create()
+        faces_to_delete = []
+        for i, faces in enumerate(facess):
+            timer.mark(f'patch_faces:{b}_{i}')
+            if len(faces) < 2:
+                continue
+            body, tln1, tln2 = patcher(faces, features)
+            if body is None:
+                futil.log(f'Could not patch chain {i} on body {b}, skipping it.')
+                continue
+            if firstTLN is None:
+                firstTLN = tln1
+            secondTLN = tln2
+            # If we are going to sew the patch into the model then we need to add it to the list of bodies to be deleted
+            stitch_entities.add(body)
+            if sew:
+                for j in range(len(faces)):
+                    unstitch_entities.add(faces[j])
+                    faces_to_delete.append(faces[j].entityToken)
+
+        # if we are not going to sew then we are done
+        if sew and unstitch_entities.count > 0:
+            secondTLN = sew_patches(active_comp, unstitch_entities, faces_to_delete, stitch_entities)
         
     if firstTLN is not None and firstTLN.index != secondTLN.index:
         timer.mark('timeline')
@@ -220,6 +345,37 @@ def patch_faces(selections: adsk.core.SelectionCommandInput, sew: bool):
     if config.TIMING:
         futil.log(format_timer(timing))
 
+def sew_patches(active_comp: adsk.fusion.Component, unstitch_entities: adsk.core.ObjectCollection, faces_to_delete: List[str], stitch_entities: adsk.core.ObjectCollection) -> adsk.fusion.TimelineObject:
+    # we know that all the faces are on the same body so we can just
+    # unstitch the body, get the parts of the unstitched body we want, and then delete the faces that are selected
+    # and then sew the body back together with the patch faces
+    
+    # now we will unstitch the body, by creating a unstitch feature
+    timer.mark('unstitch')
+    unstitch_features = active_comp.features.unstitchFeatures
+    unstitch = unstitch_features.add(unstitch_entities, False)
+    timer.mark('find_good_faces')
+    for i in range(unstitch.bodies.count):
+        # if this body has and faces in the list of faces to delete then we will not add it to the new body
+        if unstitch.bodies.item(i).faces.item(0).entityToken in faces_to_delete:
+            pass
+        else:
+            stitch_entities.add(unstitch.bodies.item(i))
+    # now we will delete the faces that are selected
+    timer.mark('delete_faces')
+    delete_features = active_comp.features.deleteFaceFeatures
+    delete_entities = adsk.core.ObjectCollection.create()
+    for i in range(len(faces_to_delete)):
+        ent_list = active_comp.parentDesign.findEntityByToken(faces_to_delete[i])
+        delete_entities.add(ent_list[0])
+    delete = delete_features.add(delete_entities)
+    # now we will sew the body back together
+    timer.mark('stitch')
+    stitch_features = active_comp.features.stitchFeatures
+    stitch_input = stitch_features.createInput(stitch_entities, adsk.core.ValueInput.createByString('0.1 mm'))
+    stitch = stitch_features.add(stitch_input)
+    return stitch.timelineObject
+
 def are_vectors_parallel(vector1: adsk.core.Vector3D, vector2: adsk.core.Vector3D, tol: float = 1e-6) -> bool:
     if abs(vector1.angleTo(vector2)) < tol:
         return True
@@ -262,30 +418,19 @@ def are_faces_tangent(face1: adsk.fusion.BRepFace, face2: adsk.fusion.BRepFace,
     return True
 
 # We must consolidate the faces into groups based on the chains of faces that are tangent to each other.
-def face_chain_finder(selections: adsk.core.SelectionCommandInput):
+def face_chain_finder(faces: List[adsk.fusion.BRepFace], permissive: bool = False) -> List[List[adsk.fusion.BRepFace]]:
     # first we will create a list of all the entity tokens for the faces
     face_tokens = []
     tangent_faces = []
-    if selections.selectionCount <= 1:
-        return [[0]]
-    
-    permissive = selections.parentCommand.commandInputs.itemById('permissive').value
+    if len(faces) <= 1:
+        return [faces]
 
-    for i in range(selections.selectionCount):
+    for i in range(len(faces)):
         timer.mark(f'find_chains:nextedge{i}')
-        face_tokens.append(selections.selection(i).entity.entityToken)
+        face_tokens.append(faces[i].entityToken)
         # Then we will create a list of all the faces that are tangent to the given face
-        valid_faces = []
         timer.mark(f'find_chains:nextedge{i}_neighbor')
-        neighbor_edges: adsk.fusion.BRepEdges = selections.selection(i).entity.edges
-        for j in range(neighbor_edges.count):
-            edge_faces = neighbor_edges.item(j).faces
-            for k in range(edge_faces.count):
-                if edge_faces.item(k).entityToken != face_tokens[i]:
-                    if are_faces_tangent(selections.selection(i).entity, edge_faces.item(k), neighbor_edges.item(j), permissive=permissive):
-                        valid_faces.append(edge_faces.item(k).entityToken)
-        # now we take the intersection of the two lists to get the faces that are tangent and neighbor faces
-        tangent_faces.append(valid_faces)
+        tangent_faces.append([face.entityToken for face in get_tangent_neighbors(faces[i], permissive)])
     
     # Then we will create a list of all the unique lists of tangent faces
     unique_tangent_chains = [[face_tokens[0]]]
@@ -305,29 +450,75 @@ def face_chain_finder(selections: adsk.core.SelectionCommandInput):
         for j in range(len(ind_to_pop)):
             unique_tangent_chains.pop(ind_to_pop[j] - j)
     
-    # also make a list of the index of the faces
-    utc_inds = []
+    # turn the chains of tokens back into chains of faces
+    face_by_token = dict(zip(face_tokens, faces))
+    chains = []
     for i in range(len(unique_tangent_chains)):
         timer.mark(f'find_chains:utc_inds{i}')
-        utc_inds.append([])
-        for j in range(len(unique_tangent_chains[i])):
-            utc_inds[i].append(face_tokens.index(unique_tangent_chains[i][j]))
-    return utc_inds
-
-def get_faces(face_tokens: List[int], input: adsk.core.SelectionCommandInput) -> List[adsk.fusion.BRepFace]:
-    faces = []
-    for i in face_tokens:
-        faces.append(input.selection(i).entity)
-    return faces
-
-def add_to_vertex_dict(vertex_dict, face: adsk.fusion.BRepFace):
-    """Add the edge to the dictionary based on its start and end vertices."""
-    for vertex in face.vertices:
-        token = vertex.entityToken
-        if token in vertex_dict:
-            vertex_dict[token].append(face)
-        else:
-            vertex_dict[token] = [face]
+        chains.append([face_by_token[token] for token in unique_tangent_chains[i]])
+    return chains
+
+def get_tangent_neighbors(face: adsk.fusion.BRepFace, permissive: bool = False) -> List[adsk.fusion.BRepFace]:
+    face_token = face.entityToken
+    tangent = []
+    neighbor_edges: adsk.fusion.BRepEdges = face.edges
+    for j in range(neighbor_edges.count):
+        edge_faces = neighbor_edges.item(j).faces
+        for k in range(edge_faces.count):
+            if edge_faces.item(k).entityToken != face_token:
+                if are_faces_tangent(face, edge_faces.item(k), neighbor_edges.item(j), permissive=permissive):
+                    tangent.append(edge_faces.item(k))
+    return tangent
+
+def strip_width(face: adsk.fusion.BRepFace) -> float:
+    # Treat the face as a long thin strip, with the area and perimeter we can solve for the short side
+    # A = l*w and P = 2*(l + w) gives w = (P - sqrt(P^2 - 16A)) / 4
+    perimeter = 0
+    for edge in face.edges:
+        perimeter += edge.length
+    disc = perimeter**2 - 16*face.area
+    if disc < 0:
+        return perimeter / 4
+    return (perimeter - math.sqrt(disc)) / 4
+
+def find_chamfer_chains(body: adsk.fusion.BRepBody, max_width: float, permissive: bool = False) -> List[List[adsk.fusion.BRepFace]]:
+    # A chamfer chain is a set of narrow faces that are only tangent to each other,
+    # a fillet is also narrow but it is tangent to the faces it blends so we can tell them apart
+    timer.mark('find_chains:auto_narrow')
+    surface_types = [adsk.core.SurfaceTypes.PlaneSurfaceType, adsk.core.SurfaceTypes.ConeSurfaceType, adsk.core.SurfaceTypes.CylinderSurfaceType, adsk.core.SurfaceTypes.NurbsSurfaceType]
+    narrow: Dict[str, adsk.fusion.BRepFace] = {}
+    for face in body.faces:
+        if face.geometry.surfaceType in surface_types and strip_width(face) <= max_width:
+            narrow[face.entityToken] = face
+
+    timer.mark('find_chains:auto_tangency')
+    neighbors: Dict[str, List[str]] = {}
+    for token, face in narrow.items():
+        tangent_tokens = [other.entityToken for other in get_tangent_neighbors(face, permissive)]
+        if len(tangent_tokens) > 0 and all(other in narrow for other in tangent_tokens):
+            neighbors[token] = tangent_tokens
+
+    # group the candidates into connected chains
+    timer.mark('find_chains:auto_group')
+    chains = []
+    visited = set()
+    for token in neighbors:
+        if token in visited:
+            continue
+        visited.add(token)
+        stack = [token]
+        chain = []
+        while stack:
+            current = stack.pop()
+            chain.append(narrow[current])
+            for other in neighbors[current]:
+                if other in neighbors and other not in visited:
+                    visited.add(other)
+                    stack.append(other)
+        if len(chain) > 1:
+            chains.append(chain)
+    futil.log(f'Found {len(chains)} chamfer chains on {body.name}')
+    return chains
 
 def add_to_edge_dict(edge_dict, edict, face: adsk.fusion.BRepFace):
     """Add the face to the dictionary based on its edges."""
@@ -339,12 +530,6 @@ def add_to_edge_dict(edge_dict, edict, face: adsk.fusion.BRepFace):
         else:
             edge_dict[token] = [face]
 
-def are_edges_connected(edge1: adsk.fusion.BRepEdge, edge2: adsk.fusion.BRepEdge) -> bool:
-    if edge1.startVertex.entityToken == edge2.startVertex.entityToken or edge1.startVertex.entityToken == edge2.endVertex.entityToken or edge1.endVertex.entityToken == edge2.startVertex.entityToken or edge1.endVertex.entityToken == edge2.endVertex.entityToken:
-        return True
-    else:
-        return False
-
 def find_farthest_edge(face: adsk.fusion.BRepFace, next_face: adsk.fusion.BRepFace) -> adsk.fusion.BRepEdge:
     # first we must figure out what edge or edges are shared between the two faces
     shared_edges: List[adsk.fusion.BRepEdge] = []
@@ -370,142 +555,371 @@ def find_farthest_edge(face: adsk.fusion.BRepFace, next_face: adsk.fusion.BRepFa
                 farthest_dist = avg_dist
     return farthest_edge
 
+def order_faces(faces: List[adsk.fusion.BRepFace], edge_dict: Dict[str, List[adsk.fusion.BRepFace]]) -> List[adsk.fusion.BRepFace]:
+    # Build a face adjacency graph from the shared edges and walk it from one end of the chain to the other
+    face_tokens = [face.entityToken for face in faces]
+    face_by_token = dict(zip(face_tokens, faces))
+    neighbors: Dict[str, List[str]] = {token: [] for token in face_tokens}
+    for edge_faces in edge_dict.values():
+        tokens = [face.entityToken for face in edge_faces]
+        for a in tokens:
+            for b in tokens:
+                if a != b and b not in neighbors[a]:
+                    neighbors[a].append(b)
+    # an open chain has to be started from one of its ends, a closed one can start anywhere
+    start = face_tokens[0]
+    for token in face_tokens:
+        if len(neighbors[token]) == 1:
+            start = token
+            break
+    ordered = [start]
+    visited = {start}
+    while True:
+        next_token = None
+        for token in neighbors[ordered[-1]]:
+            if token not in visited:
+                next_token = token
+                break
+        if next_token is None:
+            break
+        ordered.append(next_token)
+        visited.add(next_token)
+    if len(ordered) != len(face_tokens):
+        futil.log(f'Failed to order {len(face_tokens) - len(ordered)} of {len(face_tokens)} faces, they are not part of a single chain.')
+    return [face_by_token[token] for token in ordered]
+
+def walk_edge_chains(edge_ends: Dict[str, tuple]) -> (List[List[str]], List[str]):
+    # edge_ends maps an edge token to the tokens of its start and end vertex
+    # Every edge is visited exactly once so this is linear in the number of edges and always terminates
+    vertex_edges: Dict[str, List[str]] = {}
+    for token, (start, end) in edge_ends.items():
+        vertex_edges.setdefault(start, []).append(token)
+        vertex_edges.setdefault(end, []).append(token)
+
+    # a branching vertex means the boundary is not a simple chain, any two chains we walked through it would be made up
+    # so none of the edges are placed and the caller gives up on this chain
+    for vertex, tokens in vertex_edges.items():
+        if len(tokens) > 2:
+            futil.log(f'Boundary vertex {vertex} joins {len(tokens)} edges, the boundary is not a simple chain.')
+            return [], list(edge_ends.keys())
+
+    visited = set()
+    chains: List[List[str]] = []
+
+    def walk(vertex: str, token: str) -> List[str]:
+        chain = []
+        while token is not None:
+            visited.add(token)
+            chain.append(token)
+            start, end = edge_ends[token]
+            vertex = end if start == vertex else start
+            token = None
+            for candidate in vertex_edges[vertex]:
+                if candidate not in visited:
+                    token = candidate
+                    break
+        return chain
+
+    # start from the dangling vertices first so open chains are walked end to end
+    for vertex, tokens in vertex_edges.items():
+        if len(tokens) == 1 and tokens[0] not in visited:
+            chains.append(walk(vertex, tokens[0]))
+    # whatever is left over are closed loops
+    for token, (start, _) in edge_ends.items():
+        if token not in visited:
+            chains.append(walk(start, token))
+
+    # anything past the two longest chains is reported back
+    unplaced = []
+    chains.sort(key=len, reverse=True)
+    for chain in chains[2:]:
+        unplaced.extend(chain)
+    return chains[:2], unplaced
+
+class ChainBoundary:
+    faces: List[adsk.fusion.BRepFace]
+    boundaries: List[List[adsk.fusion.BRepEdge]]
+    # the edges between faces in the chain, in the order of the faces
+    rails: List[adsk.fusion.BRepEdge]
+    # for open chains the edges at each end of the chain that are not part of either boundary
+    end_caps: List[adsk.fusion.BRepEdge]
+    def __init__(self, faces, boundaries, rails, end_caps):
+        self.faces = faces
+        self.boundaries = boundaries
+        self.rails = rails
+        self.end_caps = end_caps
+
+    @property
+    def is_open(self) -> bool:
+        return len(self.end_caps) > 0
 
 # Find the loop around the edge of a set of faces
-def patcher(faces: List[adsk.fusion.BRepFace], features: adsk.fusion.Features) -> (adsk.fusion.BRepBody, adsk.fusion.TimelineObject, adsk.fusion.TimelineObject):
+def find_boundaries(faces: List[adsk.fusion.BRepFace]) -> ChainBoundary:
     edge_dict = {}
     edict = {}
     for face in faces:
         add_to_edge_dict(edge_dict, edict, face)
-    the_faces = faces.copy()
-    ordered_faces = [the_faces.pop(0)]
-    we_ok = True
-    while the_faces:
-        last_face = ordered_faces[-1]
-        matched_face = None
-        for edge in last_face.edges:
-            possible_faces = edge_dict.get(edge.entityToken, [])
-            for face in possible_faces:
-                if face != last_face and face in the_faces:  # Ensure we're not re-adding the same face
-                    matched_face = face
-                    break
-            if matched_face:
-                break
-        if matched_face:
-            we_ok = True
-            ordered_faces.append(matched_face)
-            the_faces.remove(matched_face)
-        elif we_ok:
-            # flip ordered faces and try again
-            ordered_faces.reverse()
-            we_ok = False
-        else:
-            futil.log(f'Failed to find a matching face for the last face. Something is very wrong.')
-            break
-    faces = ordered_faces
+    faces = order_faces(faces, edge_dict)
 
     interior_edges_id: Dict[adsk.fusion.BRepEdge] = {}
     exterior_edges_id: Dict[adsk.fusion.BRepEdge] = {}
     # all of the edged with more than one face attached to them are interior edges
-    for key, val in edge_dict.items():
-        if len(val) > 1:
-            interior_edges_id[key] = edict[key]
-        else:
-            exterior_edges_id[key] = edict[key]
-
-    # if the faces make a loop then we will need to make two loops and use a loft instead of a patch
-    # we will check to see if the first and last faces are tangent to each other
-    lofts = features.loftFeatures
-    loft_input = lofts.createInput(adsk.fusion.FeatureOperations.NewBodyFeatureOperation)
-
-    vertex_dict = {}
+    # we go through the faces in order so the interior edges come out in chain order
     for face in faces:
-        add_to_vertex_dict(vertex_dict, face)
-
-    boundary_edges_id_1: List[adsk.fusion.BRepEdge] = []
-    boundary_edges_id_2: List[adsk.fusion.BRepEdge] = []
-    # for the first face we want to seed the two boundary edges lists with the two edges that touch the first shared edge
-    second_face_set = set([faces[1].vertices.item(j).entityToken for j in range(faces[1].vertices.count)])
-    for i in range(faces[0].edges.count):
-        if set([faces[0].edges.item(i).startVertex.entityToken, faces[0].edges.item(i).endVertex.entityToken]).intersection(second_face_set).__len__() > 0 and faces[0].edges.item(i).entityToken in exterior_edges_id.keys():
-            if len(boundary_edges_id_1) == 0:
-                boundary_edges_id_1.append(faces[0].edges.item(i))
-            elif len(boundary_edges_id_2) == 0:
-                boundary_edges_id_2.append(faces[0].edges.item(i))
+        for edge in face.edges:
+            key = edge.entityToken
+            if len(edge_dict[key]) > 1:
+                interior_edges_id[key] = edict[key]
             else:
-                futil.log(f'Found too many seed edges for the first face.')
+                exterior_edges_id[key] = edict[key]
+
+    # if the faces make a loop then the exterior edges already form the two boundaries,
+    # if not we have to remove the edge at each end of the chain farthest from the next face to split the boundary in two
+    first_tokens = set(edge.entityToken for edge in faces[0].edges)
+    last_tokens = set(edge.entityToken for edge in faces[-1].edges)
+    shared_ends = len(first_tokens.intersection(last_tokens).intersection(interior_edges_id.keys()))
+    is_open_chain = shared_ends == 0 or (len(faces) == 2 and shared_ends < 2)
+    end_caps = []
+    if is_open_chain:
+        for farthest_edge in [find_farthest_edge(faces[0], faces[1]), find_farthest_edge(faces[-1], faces[-2])]:
+            if farthest_edge is not None and farthest_edge.entityToken in exterior_edges_id:
+                end_caps.append(exterior_edges_id.pop(farthest_edge.entityToken))
+
+    # now we can walk the boundary as a graph of edges and vertices
+    edge_ends = {}
+    for token, edge in exterior_edges_id.items():
+        edge_ends[token] = (edge.startVertex.entityToken, edge.endVertex.entityToken)
+    chains, unplaced = walk_edge_chains(edge_ends)
+    if unplaced:
+        futil.log(f'Failed to place {len(unplaced)} boundary edges: {unplaced}')
+    if len(chains) < 2:
+        futil.log(f'Found {len(chains)} boundary chains, two are needed to loft the patch.')
+        return None
+    boundaries = [[exterior_edges_id[token] for token in chain] for chain in chains]
+    return ChainBoundary(faces, boundaries, list(interior_edges_id.values()), end_caps)
+
+# Rails are what make the loft follow the original faces, but every rail adds a lot to the compute time
+# so past this many we only use the ones that matter most
+MAX_RAILS = 4
+
+def choose_strategies(chain: ChainBoundary, backend: str = 'Loft') -> List[str]:
+    # Returns the ways to build the surface for this chain, cheapest adequate one first and the fallbacks after it
+    surface_types = set(face.geometry.surfaceType for face in chain.faces)
+    if not chain.is_open and len(surface_types) == 1:
+        # a closed ring of one kind of face is fully defined by its two boundaries
+        strategies = ['loft', 'rail_subset']
+    elif len(chain.rails) <= MAX_RAILS:
+        strategies = ['rails', 'loft']
+    else:
+        strategies = ['rail_subset', 'loft']
+    if chain.is_open:
+        # the whole loop around an open chain can always be patched, it just won't have nice isocurves
+        strategies.append('patch')
+    if backend == 'Direct Fit':
+        # fitting the surface ourselves skips the loft entirely, the lofts are only kept as a fallback
+        strategies.insert(0, 'fit')
+    return strategies
+
+def pick_rails(chain: ChainBoundary, max_rails: int = MAX_RAILS) -> List[adsk.fusion.BRepEdge]:
+    # The rails where the type of surface changes are the ones that hold the shape, after that we space the rest out evenly
+    picked = []
+    others = []
+    for edge in chain.rails:
+        faces = edge.faces
+        if faces.count > 1 and faces.item(0).geometry.surfaceType != faces.item(1).geometry.surfaceType:
+            picked.append(edge)
+        else:
+            others.append(edge)
+    picked = picked[:max_rails]
+    remaining = max_rails - len(picked)
+    if remaining > 0 and len(others) > 0:
+        step = len(others) / remaining
+        for i in range(min(remaining, len(others))):
+            picked.append(others[int((i + 0.5) * step)])
+    return picked
 
-    # first we will find the edge that is farthest away from the shared edge for the first face
-    farthest_edge = find_farthest_edge(faces[0], faces[1])
-    # then we will find the edge that is farthest away from the shared edge for the last face
-    farthest_edge2 = find_farthest_edge(faces[-1], faces[-2])
+def patcher(faces: List[adsk.fusion.BRepFace], features: adsk.fusion.Features) -> (adsk.fusion.BRepBody, adsk.fusion.TimelineObject, adsk.fusion.TimelineObject):
+    chain = find_boundaries(faces)
+    if chain is None:
+        return None, None, None
+
+    backend = shared_state.load_settings(CMD_ID)["backend"]["default"]
+    for strategy in choose_strategies(chain, backend):
+        timer.mark(f'strategy:{strategy}')
+        try:
+            if strategy == 'fit':
+                feature = build_fit(chain, features)
+            elif strategy == 'patch':
+                feature = build_patch(chain, features)
+            else:
+                feature = build_loft(chain, features, strategy)
+        except Exception as error:
+            futil.log(f'Strategy {strategy} failed for a chain of {len(chain.faces)} faces ({error}), trying the next one.')
+            continue
+        if config.TIMING:
+            futil.log(f'Patched a chain of {len(chain.faces)} faces and {len(chain.rails)} rails with {strategy}')
+        return feature.bodies.item(0), feature.timelineObject, feature.timelineObject
+    return None, None, None
 
-    # we will iterate through the faces and add the edges to the boundary edges list until we reach the first face again
-    is_closed_set = (set([faces[0].vertices.item(i).entityToken for i in range(faces[0].vertices.count)]).intersection(set([faces[-1].vertices.item(i).entityToken for i in range(faces[-1].vertices.count)])).__len__() < 2 or len(faces) == 2)
-    for i in range(len(faces)):
-        edges_to_place: List[adsk.fusion.BRepFace] = []
-        for j in range(faces[i].edges.count):
-            if faces[i].edges.item(j).entityToken in exterior_edges_id.keys():
-                # first we have to exit out if one of the corners of the line does not touch a corner of another face
-                if (faces[i].edges.item(j) == farthest_edge or faces[i].edges.item(j) == farthest_edge2) and is_closed_set:
-                    interior_edges_id[faces[i].edges.item(j).entityToken] = faces[i].edges.item(j)
-                    continue
-                if i != 0: # we are going to seed the boundary edges with the first face so we dont want to be deleting those
-                    if faces[i].edges.item(j) in boundary_edges_id_1:
-                        boundary_edges_id_1.remove(faces[i].edges.item(j))
-                        interior_edges_id[faces[i].edges.item(j).entityToken] = faces[i].edges.item(j)
-                        continue
-                    elif faces[i].edges.item(j) in boundary_edges_id_2:
-                        boundary_edges_id_2.remove(faces[i].edges.item(j))
-                        interior_edges_id[faces[i].edges.item(j).entityToken] = faces[i].edges.item(j)
-                        continue
-                elif faces[i].edges.item(j) in boundary_edges_id_1 or faces[i].edges.item(j) in boundary_edges_id_2: # however we do want to skip the seeded edges if we are on the first face
-                    continue
-                edges_to_place.append(faces[i].edges.item(j))
-        while edges_to_place:
-            for edge in edges_to_place:
-                if are_edges_connected(boundary_edges_id_1[-1], edge):
-                    boundary_edges_id_1.append(edge)
-                    edges_to_place.remove(edge)
-                elif are_edges_connected(boundary_edges_id_1[0], edge):
-                    boundary_edges_id_1.insert(0, edge)
-                    edges_to_place.remove(edge)
-                elif are_edges_connected(boundary_edges_id_2[-1], edge):
-                    boundary_edges_id_2.append(edge)
-                    edges_to_place.remove(edge)
-                elif are_edges_connected(boundary_edges_id_2[0], edge):
-                    boundary_edges_id_2.insert(0, edge)
-                    edges_to_place.remove(edge)
-                else:
-                    futil.log(f'Failed to find a matching edge for the last edge.')
-    
-    # if the face is not a loop then we will have remove one edge from each end of the surface
-    # first we have to find the edge for each of the ending faces that is the farthest away from the edge shared with the next face
-
-    # fires we will make a ObjectCollection of the boundary edges
-    boundary_edges_1 = adsk.core.ObjectCollection.create()
-    for i in boundary_edges_id_1:
-        boundary_edges_1.add(i)
-    # now we will find the loop around the boundary edges
-    path_1 = adsk.fusion.Path.create(boundary_edges_1, adsk.fusion.ChainedCurveOptions.connectedChainedCurves)
-    boundary_edges_2 = adsk.core.ObjectCollection.create()
-    for i in boundary_edges_id_2:
-        boundary_edges_2.add(i)
-    # now we will find the loop around the boundary edges
-    path_2 = adsk.fusion.Path.create(boundary_edges_2, adsk.fusion.ChainedCurveOptions.connectedChainedCurves)
-    # now we will loft the two paths
-    loft_input.loftSections.add(path_1)
-    loft_input.loftSections.add(path_2)
-    for edge in interior_edges_id.values():
+def build_loft(chain: ChainBoundary, features: adsk.fusion.Features, strategy: str) -> adsk.fusion.LoftFeature:
+    lofts = features.loftFeatures
+    loft_input = lofts.createInput(adsk.fusion.FeatureOperations.NewBodyFeatureOperation)
+    for boundary in chain.boundaries:
+        boundary_edges = adsk.core.ObjectCollection.create()
+        for edge in boundary:
+            boundary_edges.add(edge)
+        # now we will find the loop around the boundary edges
+        path = adsk.fusion.Path.create(boundary_edges, adsk.fusion.ChainedCurveOptions.connectedChainedCurves)
+        loft_input.loftSections.add(path)
+    # the end caps keep the ends of the loft square with the ends of the chain so they are always used
+    rails = []
+    if strategy == 'rails':
+        rails = chain.rails
+    elif strategy == 'rail_subset':
+        rails = pick_rails(chain)
+    for edge in rails + chain.end_caps:
         loft_input.centerLineOrRails.addRail(edge)
     
     loft_input.isSolid = False
-    loft = lofts.add(loft_input)
-    return loft.bodies.item(0), loft.timelineObject, loft.timelineObject
+    return lofts.add(loft_input)
+
+def build_patch(chain: ChainBoundary, features: adsk.fusion.Features) -> adsk.fusion.PatchFeature:
+    # For an open chain the two boundaries and the end caps make one closed loop
+    loop_edges = adsk.core.ObjectCollection.create()
+    for edge in chain.boundaries[0] + chain.end_caps + chain.boundaries[1]:
+        loop_edges.add(edge)
+    path = adsk.fusion.Path.create(loop_edges, adsk.fusion.ChainedCurveOptions.connectedChainedCurves)
+    patches = features.patchFeatures
+    patch_input = patches.createInput(path, adsk.fusion.FeatureOperations.NewBodyFeatureOperation)
+    return patches.add(patch_input)
+
+def sample_path(edges: List[adsk.fusion.BRepEdge], samples: int = 8) -> (List[tuple], List[tuple]):
+    # Sample an ordered chain of edges into one polyline, flipping each edge so it continues on from the last one
+    # also returns the points where one edge hands over to the next
+    polyline = []
+    junctions = []
+    for i, edge in enumerate(edges):
+        _, start, end = edge.evaluator.getParameterExtents()
+        parameters = [start + (end - start) * j / samples for j in range(samples + 1)]
+        _, points = edge.evaluator.getPointsAtParameters(parameters)
+        points = [p.asArray() for p in points]
+        if len(polyline) > 0:
+            if surface_fit.distance(polyline[-1], points[0]) > surface_fit.distance(polyline[-1], points[-1]):
+                points.reverse()
+            junctions.append(points[0])
+            points = points[1:]
+        elif len(edges) > 1:
+            next_edge = edges[1]
+            next_points = [next_edge.startVertex.geometry.asArray(), next_edge.endVertex.geometry.asArray()]
+            if min(surface_fit.distance(points[0], p) for p in next_points) < min(surface_fit.distance(points[-1], p) for p in next_points):
+                points.reverse()
+        polyline.extend(points)
+    return polyline, junctions
+
+def build_fit(chain: ChainBoundary, features: adsk.fusion.Features) -> adsk.fusion.BaseFeature:
+    # Fit the surface directly to the boundaries and rails and bring it in as a base feature, no loft involved
+    boundary_1, junctions_1 = sample_path(chain.boundaries[0], 16)
+    boundary_2, junctions_2 = sample_path(chain.boundaries[1], 16)
+    rails = [(edge.startVertex.geometry.asArray(), edge.endVertex.geometry.asArray()) for edge in chain.end_caps + chain.rails]
+    fitted = surface_fit.fit_ruled_surface(boundary_1, boundary_2, rails, junctions_1 + junctions_2, closed=not chain.is_open, tolerance=FIT_TOLERANCE)
+    if fitted.max_deviation > FIT_TOLERANCE:
+        # it wouldn't sew back in, so let the next strategy have a go
+        raise ValueError(f'Fitted boundaries are {fitted.max_deviation * 10:.3f} mm off the chamfer')
+    surface_body = fitted_surface_body(fitted, not chain.is_open)
+    active_comp = adsk.fusion.Design.cast(app.activeProduct).activeComponent
+    base_feature = features.baseFeatures.add()
+    base_feature.startEdit()
+    active_comp.bRepBodies.add(surface_body, base_feature)
+    base_feature.finishEdit()
+    return base_feature
+
+def fitted_surface_body(fitted: surface_fit.FittedSurface, closed: bool) -> adsk.fusion.BRepBody:
+    # One NURBS face made straight from the control net, so the shared knots and the rails are exactly what we fitted
+    row_1, row_2 = fitted.control_points
+    count_u = len(row_1)
+    # the control points go in u by u with v changing fastest
+    control_points = [adsk.core.Point3D.create(*fitted.control_points[v][u]) for u in range(count_u) for v in range(2)]
+    surface = adsk.core.NurbsSurface.create(fitted.degree_u, fitted.degree_v, count_u, 2, control_points, fitted.knots_u, fitted.knots_v, [],
+                                            adsk.core.NurbsSurfaceProperties.OpenNurbsSurface, adsk.core.NurbsSurfaceProperties.OpenNurbsSurface)
+    body_def = adsk.fusion.BRepBodyDefinition.create()
+    shell_def = body_def.lumpDefinitions.add().shellDefinitions.add()
+    loop_def = shell_def.faceDefinitions.add(surface, False).loopDefinitions.add()
+
+    def point(p) -> adsk.core.Point3D:
+        return adsk.core.Point3D.create(*p)
+    start_1 = body_def.createVertexDefinition(point(row_1[0]))
+    start_2 = body_def.createVertexDefinition(point(row_2[0]))
+    # a closed chain starts and ends on the seam so the ends share their vertices and side edge
+    end_1 = start_1 if closed else body_def.createVertexDefinition(point(row_1[-1]))
+    end_2 = start_2 if closed else body_def.createVertexDefinition(point(row_2[-1]))
+    curve_1 = adsk.core.NurbsCurve3D.createNonRational([point(p) for p in row_1], fitted.degree_u, fitted.knots_u, False)
+    curve_2 = adsk.core.NurbsCurve3D.createNonRational([point(p) for p in row_2], fitted.degree_u, fitted.knots_u, False)
+    edge_1 = body_def.createEdgeDefinitionByCurve(start_1, end_1, curve_1)
+    edge_2 = body_def.createEdgeDefinitionByCurve(start_2, end_2, curve_2)
+    start_side = body_def.createEdgeDefinitionByCurve(start_1, start_2, adsk.core.Line3D.create(point(row_1[0]), point(row_2[0])))
+    end_side = start_side if closed else body_def.createEdgeDefinitionByCurve(end_1, end_2, adsk.core.Line3D.create(point(row_1[-1]), point(row_2[-1])))
+    # around the face: along the first boundary, across the far end, back along the second boundary and across the near end
+    for edge_def, opposed in [(edge_1, False), (end_side, False), (edge_2, True), (start_side, True)]:
+        loop_def.bRepCoEdgeDefinitions.add(edge_def, opposed)
+    body = body_def.createBody()
+    if body is None:
+        raise ValueError('Could not make a body from the fitted surface')
+    return body
+
+def temporary_patcher(faces: List[adsk.fusion.BRepFace]) -> adsk.fusion.BRepBody:
+    # Build a ruled surface between the two boundaries as a temporary body, nothing is added to the timeline
+    # it ignores the rails so it is not the exact patch but it is close enough to preview
+    chain = find_boundaries(faces)
+    if chain is None:
+        return None
+    temp_brep = adsk.fusion.TemporaryBRepManager.get()
+    wires = []
+    for boundary in chain.boundaries:
+        wire_body, _ = temp_brep.createWireFromCurves([edge.geometry for edge in boundary], False)
+        if wire_body is None:
+            return None
+        wires.append(wire_body.wires.item(0))
+    return temp_brep.createRuledSurface(wires[0], wires[1])
+
+def preview_faces(facess: List[List[adsk.fusion.BRepFace]]):
+    global _preview_group
+    clear_preview()
+    design = adsk.fusion.Design.cast(app.activeProduct)
+    _preview_group = design.rootComponent.customGraphicsGroups.add()
+    color = adsk.fusion.CustomGraphicsSolidColorEffect.create(adsk.core.Color.create(0, 160, 255, 255))
+    timer.mark('preview_faces')
+    for i, faces in enumerate(facess):
+        timer.mark(f'preview_faces:{i}')
+        if len(faces) < 2:
+            continue
+        try:
+            body = temporary_patcher(faces)
+        except:
+            body = None
+        if body is None:
+            futil.log(f'Could not preview chain {i}, skipping it.')
+            continue
+        graphics = _preview_group.addBRepBody(body)
+        graphics.color = color
+        graphics.isSelectable = False
+
+    timing = timer.finish()
+    if config.TIMING:
+        futil.log(format_timer(timing))
+
+def clear_preview():
+    global _preview_group
+    if _preview_group is not None and _preview_group.isValid:
+        _preview_group.deleteMe()
+    _preview_group = None
 
 
 # This event handler is called when the command terminates.
 def command_destroy(args: adsk.core.CommandEventArgs):
     global local_handlers
     local_handlers = []
+    chain_tracker.clear()
+    _feature_faces.clear()
+    _feature_chains.clear()
+    clear_preview()
     futil.log(f'{CMD_NAME} Command Destroy Event')
\ No newline at end of file
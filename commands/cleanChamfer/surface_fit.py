@@ -0,0 +1,334 @@
+#  Copyright 2023 by Ian Rist
+
+# Fits a ruled B-spline surface to a chamfer directly from points sampled along its two boundaries and its rails.
+# Points are plain (x, y, z) tuples and the surface comes back as lists, fitted_surface_body in entry.py turns it into a NurbsSurface.
+# The rails are where the original faces met, so we line the u parameter of both boundaries up at each rail,
+# that way the isocurves of the surface follow the original faces just like the loft with rails does.
+
+from typing import List, Tuple
+import bisect
+import math
+
+Point = Tuple[float, float, float]
+
+def distance(a: Point, b: Point) -> float:
+    return math.sqrt((a[0] - b[0])**2 + (a[1] - b[1])**2 + (a[2] - b[2])**2)
+
+def chord_parameters(points: List[Point]) -> List[float]:
+    # Cumulative chord length normalized to 0 to 1
+    params = [0.0]
+    for i in range(1, len(points)):
+        params.append(params[-1] + distance(points[i - 1], points[i]))
+    total = params[-1]
+    if total == 0:
+        return [i / max(len(points) - 1, 1) for i in range(len(points))]
+    return [p / total for p in params]
+
+def closest_index(points: List[Point], point: Point) -> int:
+    best = 0
+    best_dist = math.inf
+    for i, p in enumerate(points):
+        d = distance(p, point)
+        if d < best_dist:
+            best = i
+            best_dist = d
+    return best
+
+def remap_parameters(params: List[float], anchors: List[Tuple[int, float]]) -> List[float]:
+    # Piecewise linear remap of params so that params[index] lands on the target for every (index, target) anchor
+    anchors = sorted(anchors)
+    if len(anchors) == 0:
+        return params[:]
+    if anchors[0][0] != 0:
+        anchors.insert(0, (0, 0.0))
+    if anchors[-1][0] != len(params) - 1:
+        anchors.append((len(params) - 1, 1.0))
+    remapped = []
+    a = 0
+    for i, p in enumerate(params):
+        while a < len(anchors) - 2 and i > anchors[a + 1][0]:
+            a += 1
+        (i0, t0), (i1, t1) = anchors[a], anchors[a + 1]
+        p0, p1 = params[i0], params[i1]
+        if p1 == p0:
+            remapped.append(t0)
+        else:
+            remapped.append(t0 + (p - p0) / (p1 - p0) * (t1 - t0))
+    return remapped
+
+def resample(points: List[Point], params: List[float], targets: List[float]) -> List[Point]:
+    # Linearly interpolate the polyline at each target parameter, the targets have to be sorted
+    resampled = []
+    i = 0
+    for t in targets:
+        while i < len(params) - 2 and params[i + 1] < t:
+            i += 1
+        p0, p1 = params[i], params[i + 1]
+        alpha = 0.0 if p1 == p0 else min(max((t - p0) / (p1 - p0), 0.0), 1.0)
+        resampled.append(tuple(points[i][d] + (points[i + 1][d] - points[i][d]) * alpha for d in range(3)))
+    return resampled
+
+def interpolation_knots(params: List[float], degree: int) -> List[float]:
+    # Clamped knots for a curve through every sample, averaging the parameters like The NURBS Book 9.8 means the system can't be singular
+    knots = [0.0] * (degree + 1)
+    for j in range(1, len(params) - degree):
+        knots.append(sum(params[j:j + degree]) / degree)
+    knots += [1.0] * (degree + 1)
+    return knots
+
+def span_knots(breaks: List[float], pieces: List[int], degree: int) -> List[float]:
+    ''' Clamped knots with a full multiplicity knot at every break, breaks are the parameters where the edges meet.
+    The curvature of a chamfer jumps where one edge hands over to the next and the rails change how fast the second boundary
+    is parameterized, so the curve is only kept C0 in the parameter there. The edges are tangent so the surface stays smooth.
+    Between each pair of breaks there are pieces[k] - 1 more knots spread evenly. '''
+    bounds = [0.0] + breaks + [1.0]
+    knots = [0.0] * (degree + 1)
+    for k in range(len(bounds) - 1):
+        t_0, t_1 = bounds[k], bounds[k + 1]
+        if k > 0:
+            knots += [t_0] * degree
+        knots += [t_0 + (t_1 - t_0) * j / pieces[k] for j in range(1, pieces[k])]
+    knots += [1.0] * (degree + 1)
+    return knots
+
+def schoenberg_whitney(knots: List[float], degree: int, params: List[float]) -> bool:
+    ''' True if fit_curve can solve for these knots, every interior control point needs its own interior sample
+    strictly inside the span of its basis function, checked greedily in order (The NURBS Book 9.4.1).
+    The first and last control points are pinned to the end samples so they don't need one. '''
+    control_count = len(knots) - degree - 1
+    j = 1
+    last = params[0]
+    for i in range(1, control_count - 1):
+        while j < len(params) - 1 and (params[j] <= knots[i] or params[j] <= last):
+            j += 1
+        if j >= len(params) - 1 or params[j] >= knots[i + degree + 1]:
+            return False
+        last = params[j]
+        j += 1
+    return True
+
+def find_span(knots: List[float], degree: int, control_count: int, u: float) -> int:
+    if u >= knots[control_count]:
+        return control_count - 1
+    low, high = degree, control_count
+    mid = (low + high) // 2
+    while u < knots[mid] or u >= knots[mid + 1]:
+        if u < knots[mid]:
+            high = mid
+        else:
+            low = mid
+        mid = (low + high) // 2
+    return mid
+
+def basis_functions(knots: List[float], degree: int, span: int, u: float) -> List[float]:
+    # The degree + 1 non zero basis functions at u, from The NURBS Book A2.2
+    N = [1.0] + [0.0] * degree
+    left = [0.0] * (degree + 1)
+    right = [0.0] * (degree + 1)
+    for j in range(1, degree + 1):
+        left[j] = u - knots[span + 1 - j]
+        right[j] = knots[span + j] - u
+        saved = 0.0
+        for r in range(j):
+            denom = right[r + 1] + left[j - r]
+            temp = N[r] / denom if denom != 0 else 0.0
+            N[r] = saved + right[r + 1] * temp
+            saved = left[j - r] * temp
+        N[j] = saved
+    return N
+
+def solve(matrix: List[List[float]], rhs: List[List[float]]) -> List[List[float]]:
+    # Gaussian elimination with partial pivoting, the systems here are small and banded so this is plenty
+    n = len(matrix)
+    a = [row[:] + r[:] for row, r in zip(matrix, rhs)]
+    width = len(rhs[0])
+    for col in range(n):
+        pivot = max(range(col, n), key=lambda r: abs(a[r][col]))
+        if abs(a[pivot][col]) < 1e-14:
+            raise ValueError('Singular system while fitting the surface')
+        a[col], a[pivot] = a[pivot], a[col]
+        for r in range(col + 1, n):
+            f = a[r][col] / a[col][col]
+            if f != 0:
+                for c in range(col, n + width):
+                    a[r][c] -= f * a[col][c]
+    x = [[0.0] * width for _ in range(n)]
+    for r in range(n - 1, -1, -1):
+        for w in range(width):
+            s = a[r][n + w]
+            for c in range(r + 1, n):
+                s -= a[r][c] * x[c][w]
+            x[r][w] = s / a[r][r]
+    return x
+
+def fit_curve(points: List[Point], params: List[float], knots: List[float], degree: int, control_count: int) -> List[Point]:
+    # Least squares fit that interpolates the first and last point, from The NURBS Book 9.4.1
+    m = len(points) - 1
+    n = control_count - 1
+    first, last = points[0], points[-1]
+    if n <= 1:
+        return [first, last]
+    rows = []
+    residuals = []
+    for k in range(1, m):
+        span = find_span(knots, degree, control_count, params[k])
+        N = basis_functions(knots, degree, span, params[k])
+        row = [0.0] * (n + 1)
+        for j in range(degree + 1):
+            row[span - degree + j] = N[j]
+        rows.append(row)
+        residuals.append([points[k][d] - row[0] * first[d] - row[n] * last[d] for d in range(3)])
+    # normal equations for the interior control points
+    size = n - 1
+    ntn = [[0.0] * size for _ in range(size)]
+    ntr = [[0.0] * 3 for _ in range(size)]
+    for row, res in zip(rows, residuals):
+        for i in range(1, n):
+            if row[i] == 0:
+                continue
+            for d in range(3):
+                ntr[i - 1][d] += row[i] * res[d]
+            for j in range(1, n):
+                ntn[i - 1][j - 1] += row[i] * row[j]
+    interior = solve(ntn, ntr)
+    return [first] + [tuple(p) for p in interior] + [last]
+
+def rotate_loop(points: List[Point], index: int) -> List[Point]:
+    # Start a closed polyline at index and close it back on itself
+    if distance(points[0], points[-1]) < 1e-9:
+        points = points[:-1]
+    points = points[index:] + points[:index]
+    return points + [points[0]]
+
+class FittedSurface:
+    degree_u: int
+    degree_v: int
+    knots_u: List[float]
+    knots_v: List[float]
+    # control_points[v][u], v is across the chamfer and u runs along it
+    control_points: List[List[Point]]
+    # the furthest any sampled boundary point is from the fitted boundary curves
+    max_deviation: float
+    def __init__(self, degree_u, knots_u, control_points, max_deviation=0.0):
+        self.degree_u = degree_u
+        self.degree_v = 1
+        self.knots_u = knots_u
+        self.knots_v = [0.0, 0.0, 1.0, 1.0]
+        self.control_points = control_points
+        self.max_deviation = max_deviation
+
+def fit_ruled_surface(boundary_1: List[Point], boundary_2: List[Point], rails: List[Tuple[Point, Point]], breaks: List[Point] = (), degree: int = 3, closed: bool = False, tolerance: float = None) -> FittedSurface:
+    ''' Fits a degree (degree, 1) B-spline surface between two ordered boundary polylines.
+    rails is a list of (start, end) point pairs, one end on each boundary, that become isocurves of the surface.
+    breaks are the points on either boundary where one edge meets the next, each one gets a knot.
+    If the boundaries are closed loops the surface is opened up along the first rail.
+    The first fit has one piece between each pair of breaks. With a tolerance, the runs that are further off than it are split in two
+    until every run fits, and if a run can't be split any more the curves go through every sample instead. '''
+    # put the end of each rail that is on the first boundary first
+    rails = [(start, end) if distance(start, boundary_1[closest_index(boundary_1, start)]) <= distance(end, boundary_1[closest_index(boundary_1, end)]) else (end, start) for start, end in rails]
+    if closed and len(rails) > 0:
+        # the seam goes along the first rail, both ends of the opened up loops are already pinned to it
+        start, end = rails.pop(0)
+        boundary_1 = rotate_loop(boundary_1, closest_index(boundary_1, start))
+        boundary_2 = rotate_loop(boundary_2, closest_index(boundary_2, end))
+    params_1 = chord_parameters(boundary_1)
+    anchors_1 = [closest_index(boundary_1, start) for start, _ in rails]
+    anchors_2 = [closest_index(boundary_2, end) for _, end in rails]
+
+    # make sure both boundaries run the same way by checking if the rails land on the second boundary in the same order
+    order = sorted(range(len(rails)), key=lambda i: anchors_1[i])
+    rising = 0
+    for a, b in zip(order, order[1:]):
+        rising += 1 if anchors_2[b] > anchors_2[a] else -1
+    if len(order) > 1:
+        reverse = rising < 0
+    elif len(order) == 1:
+        reverse = (params_1[anchors_1[0]] < 0.5) != (anchors_2[0] < len(boundary_2) / 2)
+    else:
+        reverse = distance(boundary_1[0], boundary_2[0]) > distance(boundary_1[0], boundary_2[-1])
+    if reverse:
+        boundary_2 = boundary_2[::-1]
+        anchors_2 = [len(boundary_2) - 1 - i for i in anchors_2]
+
+    # the second boundary takes its parameters from the first one at every rail so the rails are isocurves
+    params_2 = remap_parameters(chord_parameters(boundary_2), [(a2, params_1[a1]) for a1, a2 in zip(anchors_1, anchors_2)])
+    # put the second boundary's samples at the same parameters as the first so both rows can share knots all the way up to interpolating every sample
+    resampled_2 = resample(boundary_2, params_2, params_1)
+
+    # the rails are breaks too since the second boundary's parameterization changes speed there
+    # any other break takes its parameter from whichever boundary it is on
+    break_params = [params_1[a] for a in anchors_1]
+    for point in breaks:
+        i_1, i_2 = closest_index(boundary_1, point), closest_index(boundary_2, point)
+        break_params.append(params_1[i_1] if distance(boundary_1[i_1], point) <= distance(boundary_2[i_2], point) else params_2[i_2])
+    # breaks on the two boundaries that are only a few samples apart share a knot, there wouldn't be enough samples to fit between them
+    kept = []
+    last = 0
+    for t in sorted(break_params):
+        i = nearest_index(params_1, t)
+        if i - last >= degree and len(params_1) - 1 - i >= degree:
+            kept.append(t)
+            last = i
+    break_params = kept
+    pieces = [1] * (len(break_params) + 1)
+    interpolate = len(params_1) <= degree + 1
+
+    while True:
+        # both rows share the knots so they stay lined up at the rails
+        knots = None if interpolate else span_knots(break_params, pieces, degree)
+        if knots is None or not schoenberg_whitney(knots, degree, params_1):
+            # breaks that are too close together to fit between, so go through every sample
+            interpolate = True
+            knots = interpolation_knots(params_1, degree)
+        control_count = len(knots) - degree - 1
+        row_1 = fit_curve(boundary_1, params_1, knots, degree, control_count)
+        row_2 = fit_curve(resampled_2, params_1, knots, degree, control_count)
+        # the worst deviation between each pair of breaks so only the runs that are off get more knots
+        run_deviation = [0.0] * len(pieces)
+        for row, points, params in ((row_1, boundary_1, params_1), (row_2, boundary_2, params_2)):
+            for p, u in zip(points, params):
+                run = bisect.bisect_right(break_params, u)
+                run_deviation[run] = max(run_deviation[run], distance(evaluate_curve(row, knots, degree, u), p))
+        deviation = max(run_deviation)
+        if tolerance is None or deviation <= tolerance or interpolate:
+            return FittedSurface(degree, knots, [row_1, row_2], deviation)
+        split = False
+        for k in range(len(pieces)):
+            if run_deviation[k] <= tolerance:
+                continue
+            pieces[k] *= 2
+            # stop splitting a run once its knots would leave a control point without a sample of its own
+            if schoenberg_whitney(span_knots(break_params, pieces, degree), degree, params_1):
+                split = True
+            else:
+                pieces[k] //= 2
+        # going through every sample is the most we can do, so we jump to it once nothing can be split or we'd be nearly there anyway
+        if not split or len(span_knots(break_params, pieces, degree)) - degree - 1 > len(params_1) - degree:
+            interpolate = True
+
+def nearest_index(params: List[float], t: float) -> int:
+    # Index of the sorted parameter closest to t
+    i = bisect.bisect_left(params, t)
+    if i == 0:
+        return 0
+    if i == len(params):
+        return len(params) - 1
+    return i if params[i] - t < t - params[i - 1] else i - 1
+
+def curve_deviation(control_points: List[Point], knots: List[float], degree: int, points: List[Point], params: List[float]) -> float:
+    return max(distance(evaluate_curve(control_points, knots, degree, u), p) for p, u in zip(points, params))
+
+def evaluate_curve(control_points: List[Point], knots: List[float], degree: int, u: float) -> Point:
+    span = find_span(knots, degree, len(control_points), u)
+    N = basis_functions(knots, degree, span, u)
+    point = [0.0, 0.0, 0.0]
+    for j in range(degree + 1):
+        cp = control_points[span - degree + j]
+        for d in range(3):
+            point[d] += N[j] * cp[d]
+    return tuple(point)
+
+def evaluate_surface(surface: FittedSurface, u: float, v: float) -> Point:
+    p1 = evaluate_curve(surface.control_points[0], surface.knots_u, surface.degree_u, u)
+    p2 = evaluate_curve(surface.control_points[1], surface.knots_u, surface.degree_u, u)
+    return tuple(p1[d] * (1 - v) + p2[d] * v for d in range(3))
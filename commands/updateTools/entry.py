@@ -3,13 +3,15 @@ import adsk.core, adsk.fusion, adsk.cam, traceback
 import os
 from ...lib import fusion360utils as futil
 from ... import config
+from ... import shared_state
 import time
-import random
 from typing import List, Dict
 from ...timer import Timer, format_timer
 import math
 from adsk.cam import ToolLibrary, Tool, DocumentToolLibrary
 from hashlib import sha256
+from . import tool_index
+from . import plan
 
 app = adsk.core.Application.get()
 ui: adsk.core.UserInterface = app.userInterface
@@ -25,6 +27,24 @@ COMMAND_BESIDE_ID = ''
 
 ICON_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'resources', '')
 
+DEFAULT_SETTINGS = {
+    "geometry_tolerance": {
+        "type": "dropdown",
+        "label": "Nearest Geometry Length Tolerance (mm)",
+        "options": ["0.001", "0.01", "0.05", "0.1"],
+        "default": "0.01"
+    },
+    "library_priority": {
+        "type": "dropdown",
+        "label": "Library Priority When Searching All Libraries",
+        "options": ["Cloud, Local, External", "Local, Cloud, External", "Local, External, Cloud", "External, Local, Cloud"],
+        "default": "Cloud, Local, External"
+    }
+}
+
+# Initialize the settings on first use
+shared_state.load_settings_init(CMD_ID, CMD_NAME, DEFAULT_SETTINGS, ICON_FOLDER)
+
 # Local list of event handlers used to maintain a reference so
 # they are not released and garbage collected.
 local_handlers = []
@@ -70,6 +90,8 @@ def command_created(args: adsk.core.CommandCreatedEventArgs):
     correlation_input.listItems.add('Description', True)
     correlation_input.listItems.add('Product ID', False)
     correlation_input.listItems.add('Geometry', False)
+    # exact geometry fails on tiny unit conversion differences, this takes the closest tool within the tolerances instead
+    correlation_input.listItems.add('Nearest Geometry', False)
 
     # Option to select which tooling library to use
     library_input = inputs.addDropDownCommandInput('library', 'Library', adsk.core.DropDownStyles.TextListDropDownStyle)
@@ -83,6 +105,18 @@ def command_created(args: adsk.core.CommandCreatedEventArgs):
     # print them to the console for debug
     futil.log(f'Available libraries: {libraries}')
 
+    # Search every library in one pass, the selected library always wins a tie
+    all_libraries_input = inputs.addBoolValueInput('all_libraries', 'Search All Libraries', True, '', False)
+    all_libraries_input.tooltip = 'Match against every tool library, the selected library comes first and the rest follow the library priority setting.'
+
+    # Work out what would change without touching the document
+    dry_run_input = inputs.addBoolValueInput('dry_run', 'Dry Run', True, '', False)
+    dry_run_input.tooltip = 'Show the plan of which tool each operation would be linked to, and optionally save it as CSV or JSON, without changing anything.'
+
+    # Only the relinked operations get regenerated, everything else is left alone
+    regenerate_input = inputs.addBoolValueInput('regenerate', 'Regenerate Changed Toolpaths', True, '', True)
+    regenerate_input.tooltip = 'Regenerate the toolpaths of just the operations that were relinked, in one background generation.'
+
 
 def command_execute(args: adsk.core.CommandEventArgs):
     # General logging for debug
@@ -97,11 +131,21 @@ def command_execute(args: adsk.core.CommandEventArgs):
     libraries = get_tooling_libraries()
     formatted_libraries = format_library_names(libraries)
     library_index = formatted_libraries.index(library_input.selectedItem.name)
-    library_url = adsk.core.URL.create(libraries[library_index])
-    timer.mark('get_library')
-    if config.TIMING:
-        futil.log(f'Library URL: {library_url.toString()}')
-    library = toolLibraries.toolLibraryAtURL(library_url)
+    library_urls = [libraries[library_index]]
+    if inputs.itemById('all_libraries').value:
+        library_urls += [url for url in prioritize_libraries(toolLibraries, libraries) if url != libraries[library_index]]
+    # each library is only loaded and indexed once no matter how many operations there are
+    library_list: List[ToolLibrary] = []
+    indexes: List[tool_index.ToolIndex] = []
+    for url in library_urls:
+        timer.mark('get_library')
+        if config.TIMING:
+            futil.log(f'Library URL: {url}')
+        library = toolLibraries.toolLibraryAtURL(adsk.core.URL.create(url))
+        if library is None:
+            continue
+        library_list.append(library)
+        indexes.append(get_library_index(url, library))
     timer.mark('get_operations')
     operations: List[adsk.cam.Operation] = []
     for obj_ind in range(setup_input.selectionCount):
@@ -132,106 +176,159 @@ def command_execute(args: adsk.core.CommandEventArgs):
             unique_operations.append(operation)
     operations = unique_operations
     
-    replace_with_library_tool(operations, library, correlation_type)
+    changed = replace_with_library_tool(operations, library_list, indexes, correlation_type, inputs.itemById('dry_run').value)
+    if len(changed) > 0 and inputs.itemById('regenerate').value:
+        timer.mark('regenerate')
+        regenerate_toolpaths(changed)
     timing = timer.finish()
     if config.TIMING:
         futil.log(format_timer(timing))
 
-def remove_tip_keys(tool: dict) -> dict: # APIDUMB: For some reason when you get the tool back from a operation after the file has been closed and reopened all the tip values become zero
-    # Remove the tip keys from the tool dictionary
-    keys_to_remove = ['tip-angle', 'tip-diameter', 'tip-length', 'tip-offset', 'tip-radius', 'tip-type']
-    for key in keys_to_remove:
-        if key in tool.keys():
-            tool.pop(key)
-    return tool
+def prioritize_libraries(toolLibraries: adsk.cam.ToolLibraries, libraries: List[str]) -> List[str]:
+    # Sort the libraries by location in the order from the settings, the order inside a location stays the same
+    locations = {
+        'Cloud': toolLibraries.urlByLocation(adsk.cam.LibraryLocations.CloudLibraryLocation).toString(),
+        'Local': toolLibraries.urlByLocation(adsk.cam.LibraryLocations.LocalLibraryLocation).toString(),
+        'External': toolLibraries.urlByLocation(adsk.cam.LibraryLocations.ExternalLibraryLocation).toString(),
+    }
+    priority = shared_state.load_settings(CMD_ID)["library_priority"]["default"].split(', ')
+    def rank(url: str) -> int:
+        for i, location in enumerate(priority):
+            if url.startswith(locations[location]):
+                return i
+        return len(priority)
+    return sorted(libraries, key=rank)
+
+def get_library_index(library_url: str, library: ToolLibrary) -> tool_index.ToolIndex:
+    # The whole library as one string is much quicker to hash than parsing every tool, so we only rebuild the index if that changed
+    timer.mark('library_index:marker')
+    marker = sha256(library.toJson().encode()).hexdigest()
+    timer.mark('library_index:load')
+    index = tool_index.ToolIndex.load(shared_state.settings_dir, library_url, marker)
+    if index is not None:
+        return index
+    timer.mark('library_index:build')
+    index = tool_index.ToolIndex.from_tools(library_url, marker, (library.item(i).toJson() for i in range(library.count)))
+    timer.mark('library_index:save')
+    index.save(shared_state.settings_dir)
+    return index
 
 class LibraryTool:
     tool: Tool
     document_tool: Tool = None
-    def __init__(self, tool: Tool):
+    def __init__(self, tool: Tool, keys: dict):
         self.tool = tool
+        self.keys = keys
 
-    def get_tool(self, dtl: DocumentToolLibrary) -> Tool:
+    def get_tool(self, dtl: DocumentToolLibrary, document_tools: Dict[str, Tool]) -> Tool:
         if self.document_tool is None:
-            dtl.add(self.tool)
-            self.document_tool = dtl.item(dtl.count - 1)
-        doc = json.loads(self.document_tool.toJson(), parse_float=lambda x: round(float(x), 3))
-        local = json.loads(self.tool.toJson(), parse_float=lambda x: round(float(x), 3))
-        futil.log(f'Library Tool {local["description"]} - {doc["description"]}: {self.tool.toJson()==self.document_tool.toJson()}')
+            # reuse the tool if an earlier run already put it in the document, otherwise the document library keeps growing
+            # only an exact copy is reused so a stale one with old presets or feeds is never linked to
+            self.document_tool = document_tools.get(self.keys["tool"])
+            if self.document_tool is None:
+                dtl.add(self.tool)
+                self.document_tool = dtl.item(dtl.count - 1)
+                document_tools[self.keys["tool"]] = self.document_tool
+        # this comparison is only for debugging so we don't pay for the json unless it is going to be logged
+        if config.DEBUG:
+            doc = json.loads(self.document_tool.toJson(), parse_float=tool_index.round_float)
+            local = json.loads(self.tool.toJson(), parse_float=tool_index.round_float)
+            futil.log(f'Library Tool {local["description"]} - {doc["description"]}: {self.tool.toJson()==self.document_tool.toJson()}')
         return self.document_tool
 
-def replace_with_library_tool(operations: List[adsk.cam.Operation], library: ToolLibrary, correlation_type: str):
+def replace_with_library_tool(operations: List[adsk.cam.Operation], libraries: List[ToolLibrary], indexes: List[tool_index.ToolIndex], correlation_type: str, dry_run: bool = False) -> List[adsk.cam.Operation]:
+    # Returns the operations that were relinked
     timer.mark('replace_tool')
-    # Iterate through each operation in the setup and replace the tool with the library tool
-    library_tool_description: Dict[str, int] = {}
-    library_tool_product_ids: Dict[str, int] = {}
-    library_tool_geometry_hash: Dict[str, int] = {}
-    library_tool_used: List[LibraryTool] = []
-    bad_correlation = False
-    cam = adsk.cam.CAM.cast(app.activeProduct)
-    dtl = cam.documentToolLibrary
-    geom_debug = "Library tools: \n"
-    timer.mark('replace_tool:get_tools_info')
-    for i in range(library.count):
-        timer.mark(f'replace_tool:get_tools_info:next_tool')
-        tool: Tool = library.item(i)
-        tool_json = json.loads(tool.toJson(), parse_float=lambda x: round(float(x), 3)) # APIDUMB: All the floats coming out of a newly opened file are .3f so we need to do this so the hash matches
-        library_tool_used.append(LibraryTool(tool))
-        lib_num = library_tool_used.__len__() - 1
-        
-        library_tool_description[tool_json["description"]] = lib_num
-        library_tool_product_ids[tool_json["product-id"]] = lib_num
-        if "geometry" in tool_json.keys():
-            geometry = json.dumps(remove_tip_keys(tool_json["geometry"]))
-            geometry_hash = sha256(geometry.encode()).hexdigest()
-            geom_debug += f'{geometry_hash}: \"{geometry}\"\n'
-            library_tool_geometry_hash[geometry_hash] = lib_num
-    geom_debug += "Setup tools: \n"
-    timer.mark('replace_tool:iterate_operations')
+    rows = plan_correlation(operations, indexes, correlation_type)
+    if dry_run:
+        # nothing in the document is touched, we just show the plan and offer to save it
+        timer.mark('replace_tool:report')
+        futil.log(plan.format_plan(rows), force_console=True)
+        good = sum(1 for row in rows if row.is_good and not row.up_to_date)
+        current = sum(1 for row in rows if row.up_to_date)
+        answer = ui.messageBox(f'{good} of {len(rows)} operations would be relinked with their preset, {current} are already up to date.\nThe full plan is in the Text Command Panel.\n\nSave the plan to a file?',
+                               'Update Tools Plan', adsk.core.MessageBoxButtonTypes.YesNoButtonType)
+        if answer == adsk.core.DialogResults.DialogYes:
+            export_plan(rows)
+        return []
+    return apply_plan(operations, rows, libraries, indexes)
+
+def plan_correlation(operations: List[adsk.cam.Operation], indexes: List[tool_index.ToolIndex], correlation_type: str) -> List[plan.PlanRow]:
+    # Works out what every operation would be relinked to without changing anything, one row per operation
+    # lots of operations share a tool, so each distinct tool is only parsed and hashed once
+    # APIDUMB: there is no way to get at a tool's guid without the json so the json text is the identity
+    operation_tool_keys: Dict[str, dict] = {}
+    length_tolerance = float(shared_state.load_settings(CMD_ID)["geometry_tolerance"]["default"])
+    library_names = format_library_names([index.url for index in indexes])
+    rows: List[plan.PlanRow] = []
+    timer.mark('replace_tool:plan_operations')
     for operation in operations:
         timer.mark(f'replace_tool:get_tool')
-        tool = operation.tool
-        tool_json = json.loads(tool.toJson(), parse_float=lambda x: round(float(x), 3)) # APIDUMB: WHAT IF I DONT WANT TO USE JSON??? WHAT ABOUT JUST ACCESSING THE PROPERTIES DIRECTLY???
-        preset_name: str
-        if operation.toolPreset is None:
-            preset_name = ''
-        else:
-            preset_name = operation.toolPreset.name
-        # futil.log(f'Tool: {json.dumps(tool_json)}')
-        print_str = f'Operation: {operation.name}'
+        tool_text = operation.tool.toJson() # APIDUMB: WHAT IF I DONT WANT TO USE JSON??? WHAT ABOUT JUST ACCESSING THE PROPERTIES DIRECTLY???
+        keys = operation_tool_keys.get(tool_text)
+        if keys is None:
+            timer.mark(f'replace_tool:parse_tool')
+            keys = tool_index.tool_keys(tool_text)
+            operation_tool_keys[tool_text] = keys
+        preset_name = '' if operation.toolPreset is None else operation.toolPreset.name
         timer.mark(f'replace_tool:correlate_operation')
-        # pad the string to 32 characters
-        print_str += ' ' * (32 - len(operation.name))
+        library_tool, distance = tool_index.find_in_indexes(indexes, correlation_type, keys, length_tolerance)
         if correlation_type == 'Description':
-            description = tool_json["description"]
-            print_str += f'matching by Description: {description}'
-            if description != '': # dont match if the description is empty
-                library_tool = library_tool_description.get(description)
+            match_key = f'Description: {keys["description"]}'
         elif correlation_type == 'Product ID':
-            product_id = tool_json["product-id"]
-            print_str += f'matching by Product ID: {product_id}'
-            if product_id != '': # dont match if the product id is empty
-                library_tool = library_tool_product_ids.get(product_id)
+            match_key = f'Product ID: {keys["product-id"]}'
         elif correlation_type == 'Geometry':
-            geometry = json.dumps(remove_tip_keys(tool_json["geometry"]))
-            geometry_hash = sha256(geometry.encode()).hexdigest()
-            geom_debug += f'{geometry_hash}: \"{geometry}\"\n'
-            print_str += f'matching by Geometry Hash: {geometry_hash}'
-            library_tool = library_tool_geometry_hash.get(geometry_hash)
+            match_key = f'Geometry Hash: {keys["geometry"]}'
+        else:
+            match_key = 'Nearest Geometry' + (f' (distance {distance:.3f})' if distance is not None else '')
+        row = plan.PlanRow(operation.name, keys["description"], match_key, preset_name)
+        if library_tool is not None:
+            library_number, position = library_tool
+            entry = indexes[library_number].entries[position]
+            row.library_tool = library_tool
+            row.matched_tool = entry["description"]
+            row.library = library_names[library_number]
+            row.preset_status = 'found' if preset_name in entry["presets"] else 'missing'
+            # the operation's tool already is the library tool, the preset comes from that same tool so it can't change either
+            row.up_to_date = row.preset_status == 'found' and keys["tool"] == entry["tool"]
+        rows.append(row)
+    return rows
+
+def apply_plan(operations: List[adsk.cam.Operation], rows: List[plan.PlanRow], libraries: List[ToolLibrary], indexes: List[tool_index.ToolIndex]) -> List[adsk.cam.Operation]:
+    # Iterate through each operation in the setup and replace the tool with the library tool
+    # the library tools are only pulled out of the library when something matches them
+    # keyed by (library number, tool position)
+    library_tool_used: Dict[tuple, LibraryTool] = {}
+    bad_correlation = False
+    changed: List[adsk.cam.Operation] = []
+    cam = adsk.cam.CAM.cast(app.activeProduct)
+    dtl = cam.documentToolLibrary
+    timer.mark('replace_tool:index_document_tools')
+    document_tools = index_document_tools(dtl)
+    timer.mark('replace_tool:iterate_operations')
+    for operation, row in zip(operations, rows):
+        # pad the string to 32 characters
+        print_str = f'Operation: {operation.name}' + ' ' * (32 - len(operation.name)) + f'matching by {row.match_key}'
         timer.mark(f'replace_tool:set_tool')
-        if library_tool:
-            lib_tool = library_tool_used[library_tool]
+        if row.up_to_date:
+            # setting the same tool and preset again would still mark the toolpath as out of date
+            print_str += f'\t Already up to date'
+        elif row.library_tool is not None:
+            library_number, position = row.library_tool
+            if row.library_tool not in library_tool_used:
+                library_tool_used[row.library_tool] = LibraryTool(libraries[library_number].item(position), indexes[library_number].entries[position])
+            lib_tool = library_tool_used[row.library_tool]
             print_str += f'\t Found Match'
-            operation.tool = lib_tool.get_tool(dtl)
-            presets = json.loads(lib_tool.tool.toJson())['start-values']['presets']
-            preset_descriptions = [preset['name'] for preset in presets]
-            if preset_name in preset_descriptions:
-                items = lib_tool.tool.presets.itemsByName(preset_name)
+            document_tool = lib_tool.get_tool(dtl, document_tools)
+            operation.tool = document_tool
+            changed.append(operation)
+            if row.preset_status == 'found':
+                # the preset has to come from the tool the operation now has
+                items = document_tool.presets.itemsByName(row.preset)
                 operation.toolPreset = items[0]
-                print_str += f'\t Preset: {preset_name} successfully set'
+                print_str += f'\t Preset: {row.preset} successfully set'
             else:
-                print_str += f'\t Preset: {preset_name} not found in library tool'
-                # futil.log(f"{json.dumps(presets)}\n{preset_descriptions}")
+                print_str += f'\t Preset: {row.preset} not found in library tool'
                 bad_correlation = True
         else:
             print_str += f'\t No Match Found'
@@ -240,17 +337,47 @@ def replace_with_library_tool(operations: List[adsk.cam.Operation], library: Too
         futil.log(print_str)
     timer.mark('donedone')
 
-    # save geom_debug to a file for debug
-    # fn = f'geom_debug_{time.strftime("%Y%m%d-%H%M%S")}.txt'
-    # with open(fn, 'w') as f:
-    #     f.write(geom_debug)
-    # log the file location
-    # futil.log(f'Geometry Debug: {fn}')
-    # futil.log(f"Directory: {os.getcwd()}")
-
     if bad_correlation:
         ui.messageBox(f'Some tools could not be correlated to the library.\nCheck the Text Command Panel for details.')
-    
+    return changed
+
+def regenerate_toolpaths(operations: List[adsk.cam.Operation]):
+    # One generate call for all of the changed operations, Fusion runs it in the background and we just show how far along it is
+    cam = adsk.cam.CAM.cast(app.activeProduct)
+    collection = adsk.core.ObjectCollection.create()
+    for operation in operations:
+        collection.add(operation)
+    future = cam.generateToolpath(collection)
+    progress = ui.createProgressDialog()
+    progress.isCancelButtonShown = True
+    progress.show('Regenerating Toolpaths', 'Generated %v of %m relinked toolpaths', 0, future.numberOfOperations)
+    while not future.isGenerationCompleted:
+        # cancelling only closes this dialog, the toolpaths keep generating
+        if progress.wasCancelled:
+            break
+        progress.progressValue = future.numberOfCompleted
+        adsk.doEvents()
+        time.sleep(0.1)
+    progress.hide()
+    futil.log(f'Regenerating {future.numberOfOperations} relinked toolpaths, {future.numberOfCompleted} done')
+
+def index_document_tools(dtl: DocumentToolLibrary) -> Dict[str, Tool]:
+    # The tools already in the document keyed by the hash of their whole json, the first one wins if there are copies
+    document_tools: Dict[str, Tool] = {}
+    for i in range(dtl.count):
+        tool = dtl.item(i)
+        keys = tool_index.tool_keys(tool.toJson())
+        document_tools.setdefault(keys["tool"], tool)
+    return document_tools
+
+def export_plan(rows: List[plan.PlanRow]):
+    file_dialog = ui.createFileDialog()
+    file_dialog.title = 'Save the Update Tools Plan'
+    file_dialog.filter = 'CSV (*.csv);;JSON (*.json)'
+    if file_dialog.showSave() != adsk.core.DialogResults.DialogOK:
+        return
+    plan.write_plan(file_dialog.filename, rows)
+    futil.log(f'Plan saved to {file_dialog.filename}')
 
 def command_preselect(args: adsk.core.SelectionEventArgs):
     # APINOTDUMB: This runs when you open a command and so it acts like a selection filter
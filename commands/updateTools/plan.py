@@ -0,0 +1,51 @@
+#  Copyright 2023 by Ian Rist
+
+# The correlation plan for Update Tools, what every operation would be relinked to, so it can be checked before anything is changed.
+# Each row is plain text so the plan can be shown in the Text Command Panel or saved as CSV or JSON.
+
+from typing import List
+import csv
+import json
+
+PLAN_COLUMNS = ['operation', 'current_tool', 'matched_tool', 'library', 'preset', 'preset_status', 'match_key', 'up_to_date']
+
+class PlanRow:
+    ''' One operation in the plan, library_tool is (library number, tool position) of the match or None.
+    up_to_date is set when the operation already has the matched tool and preset so relinking it would change nothing. '''
+    def __init__(self, operation: str, current_tool: str, match_key: str, preset: str):
+        self.operation = operation
+        self.current_tool = current_tool
+        self.match_key = match_key
+        self.preset = preset
+        self.library_tool = None
+        self.matched_tool = ''
+        self.library = ''
+        self.preset_status = 'no match'
+        self.up_to_date = False
+
+    @property
+    def is_good(self) -> bool:
+        return self.library_tool is not None and self.preset_status == 'found'
+
+    def as_dict(self) -> dict:
+        return {column: getattr(self, column) for column in PLAN_COLUMNS}
+
+def format_plan(rows: List[PlanRow]) -> str:
+    # A fixed width table for the Text Command Panel
+    widths = {column: max([len(column)] + [len(str(getattr(row, column))) for row in rows]) for column in PLAN_COLUMNS}
+    lines = ['  '.join(column.ljust(widths[column]) for column in PLAN_COLUMNS)]
+    for row in rows:
+        lines.append('  '.join(str(getattr(row, column)).ljust(widths[column]) for column in PLAN_COLUMNS))
+    return '\n'.join(lines)
+
+def write_plan(path: str, rows: List[PlanRow]):
+    # JSON if the file ends in .json, otherwise CSV
+    if path.lower().endswith('.json'):
+        with open(path, 'w') as file:
+            json.dump([row.as_dict() for row in rows], file, indent=4)
+        return
+    with open(path, 'w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=PLAN_COLUMNS)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(row.as_dict())
@@ -0,0 +1,188 @@
+#  Copyright 2023 by Ian Rist
+
+# The correlation keys of every tool in a library, saved next to the settings so big libraries are only parsed when they change.
+# Entries are built from the tool json text, so library tools, document tools and operation tools are all keyed the same way.
+
+from typing import Dict, Iterable, List, Tuple
+from hashlib import sha256
+import json
+import math
+import os
+
+# bump this when the entries change so old index files get rebuilt
+INDEX_VERSION = 4
+
+# The geometry fields that make up the feature vector for nearest geometry matching, lengths are compared in mm and angles in degrees
+FEATURE_FIELDS = [('DC', 'length'), ('LCF', 'length'), ('OAL', 'length'), ('RE', 'length'), ('SFDM', 'length'), ('LB', 'length'), ('NOF', 'count'), ('SIG', 'angle'), ('TA', 'angle')]
+ANGLE_TOLERANCE = 0.1
+
+def remove_tip_keys(tool: dict) -> dict: # APIDUMB: For some reason when you get the tool back from a operation after the file has been closed and reopened all the tip values become zero
+    # Remove the tip keys from the tool dictionary
+    keys_to_remove = ['tip-angle', 'tip-diameter', 'tip-length', 'tip-offset', 'tip-radius', 'tip-type']
+    for key in keys_to_remove:
+        if key in tool.keys():
+            tool.pop(key)
+    return tool
+
+def round_float(x: str) -> float:
+    # APIDUMB: All the floats coming out of a newly opened file are .3f so we need to do this so the hash matches
+    return round(float(x), 3)
+
+def geometry_hash(tool_json: dict) -> str:
+    if "geometry" not in tool_json.keys():
+        return ''
+    geometry = json.dumps(remove_tip_keys(dict(tool_json["geometry"])))
+    return sha256(geometry.encode()).hexdigest()
+
+def tool_hash(tool_json: dict) -> str:
+    # The whole tool, presets and all, so two tools with the same hash can be swapped without changing anything
+    tool = dict(tool_json)
+    tool.pop("last_modified", None)
+    if "geometry" in tool.keys():
+        tool["geometry"] = remove_tip_keys(dict(tool["geometry"]))
+    return sha256(json.dumps(tool, sort_keys=True).encode()).hexdigest()
+
+def geometry_features(tool_json: dict) -> List[float]:
+    # The numbers that describe the shape of the tool, or None if it doesn't have any geometry
+    geometry = tool_json.get("geometry")
+    if not geometry:
+        return None
+    scale = 25.4 if tool_json.get("unit") == "inches" else 1.0
+    features = []
+    for key, kind in FEATURE_FIELDS:
+        value = geometry.get(key, 0.0)
+        value = float(value) if isinstance(value, (int, float)) else 0.0
+        features.append(value * scale if kind == 'length' else value)
+    return features
+
+def feature_tolerances(length_tolerance: float) -> List[float]:
+    # counts like the number of flutes have to be the same, anything under one apart is the same count
+    return [{'length': length_tolerance, 'angle': ANGLE_TOLERANCE, 'count': 0.5}[kind] for _, kind in FEATURE_FIELDS]
+
+def tool_keys(tool_text: str) -> dict:
+    # Everything we correlate on for one tool, plus the preset names so we never have to parse the tool again to check them
+    # the hashes need the rounded floats to match across files, but rounding to .3f in inches is coarser than the
+    # geometry tolerance so the features come from the values as they are
+    tool_json = json.loads(tool_text, parse_float=round_float)
+    presets = tool_json.get("start-values", {}).get("presets", [])
+    return {
+        "description": tool_json.get("description", ''),
+        "product-id": tool_json.get("product-id", ''),
+        "geometry": geometry_hash(tool_json),
+        "tool": tool_hash(tool_json),
+        "presets": [preset.get("name", '') for preset in presets],
+        "type": tool_json.get("type", ''),
+        "features": geometry_features(json.loads(tool_text)),
+    }
+
+class GeometryMatcher:
+    ''' Finds the library tool with the closest geometry where every field is within its tolerance.
+    Tools are put on a grid by type and diameter with cells one tolerance wide, so a lookup only checks the tools in the neighbouring cells.
+    The distance is the root sum square of each field's difference in units of its tolerance. '''
+    def __init__(self, entries: List[dict], tolerances: List[float]):
+        self.entries = entries
+        self.tolerances = tolerances
+        self.grid: Dict[Tuple[str, int], List[int]] = {}
+        for i, entry in enumerate(entries):
+            if entry["features"] is not None:
+                self.grid.setdefault((entry["type"], self.cell(entry["features"])), []).append(i)
+
+    def cell(self, features: List[float]) -> int:
+        return math.floor(features[0] / self.tolerances[0])
+
+    def find(self, keys: dict) -> Tuple[int, float]:
+        # Returns (position, distance) of the closest tool, or (None, None) if nothing is within tolerance
+        features = keys["features"]
+        if features is None:
+            return None, None
+        best, best_distance = None, math.inf
+        cell = self.cell(features)
+        for neighbour in (cell - 1, cell, cell + 1):
+            for i in self.grid.get((keys["type"], neighbour), []):
+                distance = 0.0
+                for value, other, tolerance in zip(features, self.entries[i]["features"], self.tolerances):
+                    difference = abs(value - other) / tolerance
+                    if difference > 1:
+                        break
+                    distance += difference * difference
+                else:
+                    if distance < best_distance:
+                        best, best_distance = i, distance
+        if best is None:
+            return None, None
+        return best, math.sqrt(best_distance)
+
+class ToolIndex:
+    ''' The correlation keys of every tool in a library in library order, with a lookup for each correlation type.
+    The marker changes whenever the library does so a saved index is only used if it is still current. '''
+    def __init__(self, url: str, marker: str, entries: List[dict]):
+        self.url = url
+        self.marker = marker
+        self.entries = entries
+        self.lookups: Dict[str, Dict[str, int]] = {'Description': {}, 'Product ID': {}, 'Geometry': {}}
+        # the geometry matcher is only built if nearest geometry matching is used
+        self.matcher: GeometryMatcher = None
+        for i, entry in enumerate(entries):
+            # empty keys never match anything
+            if entry["description"] != '':
+                self.lookups['Description'][entry["description"]] = i
+            if entry["product-id"] != '':
+                self.lookups['Product ID'][entry["product-id"]] = i
+            if entry["geometry"] != '':
+                self.lookups['Geometry'][entry["geometry"]] = i
+
+    @classmethod
+    def from_tools(cls, url: str, marker: str, tool_texts: Iterable[str]) -> 'ToolIndex':
+        return cls(url, marker, [tool_keys(tool_text) for tool_text in tool_texts])
+
+    def find(self, correlation_type: str, keys: dict) -> int:
+        # Returns the position of the matching library tool or None
+        key = keys[{'Description': 'description', 'Product ID': 'product-id', 'Geometry': 'geometry'}[correlation_type]]
+        if key == '':
+            return None
+        return self.lookups[correlation_type].get(key)
+
+    def find_nearest(self, keys: dict, length_tolerance: float) -> Tuple[int, float]:
+        # Returns (position, distance) of the library tool with the closest geometry within tolerance, or (None, None)
+        tolerances = feature_tolerances(length_tolerance)
+        if self.matcher is None or self.matcher.tolerances != tolerances:
+            self.matcher = GeometryMatcher(self.entries, tolerances)
+        return self.matcher.find(keys)
+
+    def save(self, directory: str):
+        with open(index_path(directory, self.url), 'w') as file:
+            json.dump({"version": INDEX_VERSION, "url": self.url, "marker": self.marker, "entries": self.entries}, file)
+
+    @classmethod
+    def load(cls, directory: str, url: str, marker: str) -> 'ToolIndex':
+        # Returns None if there is no saved index or it is out of date
+        path = index_path(directory, url)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'r') as file:
+                saved = json.load(file)
+        except ValueError:
+            return None
+        if saved.get("version") != INDEX_VERSION or saved.get("url") != url or saved.get("marker") != marker:
+            return None
+        return cls(url, marker, saved["entries"])
+
+def find_in_indexes(indexes: List[ToolIndex], correlation_type: str, keys: dict, length_tolerance: float) -> Tuple[Tuple[int, int], float]:
+    ''' Looks the tool up in several library indexes that are in priority order.
+    Returns ((library number, tool position), distance) or (None, None), exact matches take the first library that has one
+    and nearest geometry takes the closest tool with ties going to the earlier library. '''
+    best, best_distance = None, None
+    for k, index in enumerate(indexes):
+        if correlation_type == 'Nearest Geometry':
+            position, distance = index.find_nearest(keys, length_tolerance)
+            if position is not None and (best_distance is None or distance < best_distance):
+                best, best_distance = (k, position), distance
+        else:
+            position = index.find(correlation_type, keys)
+            if position is not None:
+                return (k, position), None
+    return best, best_distance
+
+def index_path(directory: str, url: str) -> str:
+    return os.path.join(directory, f'ToolIndex_{sha256(url.encode()).hexdigest()[:16]}.json')
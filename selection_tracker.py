@@ -0,0 +1,47 @@
+#  Copyright 2023 by Ian Rist
+
+from typing import Callable, List
+import adsk.core
+
+class SelectionTracker:
+    ''' Caches data derived from each entity in a selection input so it is only computed once per selection.
+    Call update from inputChanged and read the cached values from preSelect and validateInputs. '''
+    def __init__(self, derive: Callable):
+        self.derive = derive
+        self.clear()
+
+    def clear(self):
+        self.tokens: List[str] = []
+        self.values: List = []
+
+    def update(self, selection_input: adsk.core.SelectionCommandInput):
+        count = selection_input.selectionCount
+        if count == 0:
+            self.clear()
+            return
+        # Selections are almost always appended, so if the last entity we know about is still in place we only derive the new ones
+        known = len(self.tokens)
+        if known <= count and (known == 0 or selection_input.selection(known - 1).entity.entityToken == self.tokens[-1]):
+            for i in range(known, count):
+                entity = selection_input.selection(i).entity
+                self._add(entity.entityToken, self.derive(entity))
+            return
+        # Otherwise something was removed, so we rebuild reusing whatever we have already derived
+        cached = dict(zip(self.tokens, self.values))
+        self.clear()
+        for i in range(count):
+            entity = selection_input.selection(i).entity
+            token = entity.entityToken
+            self._add(token, cached[token] if token in cached else self.derive(entity))
+
+    def _add(self, token: str, value):
+        self.tokens.append(token)
+        self.values.append(value)
+
+    def first(self):
+        if len(self.values) == 0:
+            return None
+        return self.values[0]
+
+    def __len__(self):
+        return len(self.tokens)
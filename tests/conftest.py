@@ -0,0 +1,12 @@
+# The commands package imports adsk, so the modules that don't need Fusion are loaded straight from their files
+
+import importlib.util
+import os
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def load_module(name: str, *path: str):
+    spec = importlib.util.spec_from_file_location(name, os.path.join(ROOT, *path))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
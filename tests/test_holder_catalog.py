@@ -0,0 +1,55 @@
+import json
+
+from conftest import load_module
+
+catalog = load_module('holder_catalog', 'commands', 'addHolder', 'catalog.py')
+
+CSV_HEADER = 'name,product_id,product_link,vendor,z1,z2,r1,r2\n'
+
+def read(path):
+    return {name: (data, error) for name, data, error in catalog.catalog_holder_data(str(path))}
+
+def test_csv_rows_with_the_same_name_are_one_holder(tmp_path):
+    path = tmp_path / 'holders.csv'
+    path.write_text(CSV_HEADER + 'BT30,1,,Acme,10,40,15,15\nBT30,1,,Acme,0,10,10,15\nER16,2,,Acme,0,20,11,11\n')
+    holders = read(path)
+    data, error = holders['BT30']
+    assert error is None
+    # sorted along the axis and turned into heights and diameters
+    assert [(s["height"], s["lower-diameter"], s["upper-diameter"]) for s in data["segments"]] == [(10, 20, 30), (30, 30, 30)]
+    assert data["product-id"] == '1' and data["vendor"] == 'Acme'
+    assert holders['ER16'][1] is None
+
+def test_a_bad_csv_row_only_loses_its_own_holder(tmp_path):
+    path = tmp_path / 'holders.csv'
+    path.write_text(CSV_HEADER + 'BT30,1,,,0,10,ten,15\nBT30,1,,,10,40,15,15\nER16,2,,,0,20,11,11\n')
+    holders = read(path)
+    data, error = holders['BT30']
+    assert data is None and error.startswith('line 2')
+    assert holders['ER16'][1] is None
+
+def test_json_holders_with_bad_entries_are_reported(tmp_path):
+    path = tmp_path / 'holders.json'
+    path.write_text(json.dumps([
+        {"name": "BT30", "segments": [[0, 10, 10, 15], [10, 40, 15, 15]]},
+        {"name": "broken", "segments": [[0, 10, 10]]},
+        {"name": "empty", "segments": []},
+        "not a holder",
+    ]))
+    holders = read(path)
+    assert holders['BT30'][1] is None
+    assert holders['broken'][0] is None and holders['broken'][1].startswith('entry 1')
+    assert holders['empty'] == (None, 'no segments')
+    assert holders['entry 3'][0] is None
+
+def test_gaps_and_overlaps_are_reported(tmp_path):
+    path = tmp_path / 'holders.json'
+    path.write_text(json.dumps([
+        {"name": "gap", "segments": [[0, 10, 10, 15], [12, 40, 15, 15]]},
+        {"name": "overlap", "segments": [[0, 10, 10, 15], [8, 40, 15, 15]]},
+        {"name": "lifted", "segments": [[5, 10, 10, 15]]},
+    ]))
+    holders = read(path)
+    assert holders['gap'] == (None, 'gap between z 10 mm and 12 mm')
+    assert holders['overlap'] == (None, 'overlap between z 10 mm and 8 mm')
+    assert holders['lifted'] == (None, 'gap between z 0 mm and 5 mm')
@@ -0,0 +1,83 @@
+import math
+import random
+
+from conftest import load_module
+
+holder_profile = load_module('holder_profile', 'commands', 'addHolder', 'profile.py')
+
+def radius_at(profile, z):
+    return max(r_1 + (r_2 - r_1) * (z - z_1) / (z_2 - z_1) for z_1, z_2, r_1, r_2 in profile if z_1 <= z <= z_2)
+
+def assert_within(original, compacted, tol):
+    for z in [i * (original[-1][1] / 1000) for i in range(1001)]:
+        difference = radius_at(compacted, z) - radius_at(original, z)
+        assert -1e-9 <= difference <= tol + 1e-9, (z, difference)
+
+def test_compact_merges_collinear_segments():
+    profile = [[0, 1, 1, 1], [1, 2, 1, 1], [2, 3, 1, 2], [3, 4, 2, 3]]
+    assert holder_profile.compact_profile(profile, 0.0) == [[0, 2, 1, 1], [2, 4, 1, 3]]
+
+def test_compact_merges_a_long_tessellated_taper():
+    profile = [[i * 0.01, (i + 1) * 0.01, 1 + i * 0.001, 1 + (i + 1) * 0.001] for i in range(4000)]
+    compacted = holder_profile.compact_profile(profile, 0.001)
+    assert len(compacted) == 1
+    assert abs(compacted[0][1] - 40) < 1e-9 and abs(compacted[0][3] - 5) < 1e-9
+
+def test_compact_keeps_a_chamfer_after_a_cylinder():
+    profile = [[0, 1, 2, 2], [1, 1.2, 2, 1.5]]
+    compacted = holder_profile.compact_profile(profile, 0.001)
+    assert compacted == profile
+    assert_within(profile, compacted, 0.001)
+
+def test_compact_stays_within_tolerance_of_noisy_profile():
+    random.seed(3)
+    profile = []
+    r = 1.0
+    for i in range(400):
+        r_next = 1.0 + 0.0004 * math.sin(i / 7) + random.uniform(-0.0002, 0.0002)
+        profile.append([i * 0.01, (i + 1) * 0.01, r, r_next])
+        r = r_next
+    compacted = holder_profile.compact_profile(profile, 0.001)
+    assert len(compacted) < len(profile) / 4
+    assert_within(profile, compacted, 0.001)
+
+def test_compact_keeps_steps():
+    profile = [[0, 1, 1, 1], [1, 2, 2, 2]]
+    assert holder_profile.compact_profile(profile, 0.01) == profile
+
+def test_upper_envelope_hides_inner_segments():
+    segments = [(1, 1, 0, 2), (0.5, 0.5, 0.5, 1.5), (2, 2, 2, 3)]
+    assert holder_profile.upper_envelope(segments) == [[0, 2, 1, 1], [2, 3, 2, 2]]
+
+def test_mesh_edges_give_the_outside_of_a_stepped_cylinder():
+    # two stacked tubes, radius 2 from z 0 to 1 then radius 1 from z 1 to 3, with the inner faces hidden by the outer ones
+    sides = 12
+    rings = [(2.0, 0.0), (2.0, 1.0), (1.0, 1.0), (1.0, 3.0), (0.5, 0.0), (0.5, 3.0)]
+    points = []
+    for r, z in rings:
+        for k in range(sides):
+            angle = 2 * math.pi * k / sides
+            points.append((r * math.cos(angle), r * math.sin(angle), z))
+    indices = []
+    for ring_a, ring_b in ((0, 1), (2, 3), (4, 5)):
+        for k in range(sides):
+            a, b = ring_a * sides + k, ring_a * sides + (k + 1) % sides
+            c, d = ring_b * sides + k, ring_b * sides + (k + 1) % sides
+            indices += [a, b, c, b, d, c]
+    cylindrical = holder_profile.project_points(points, (0, 0, 0), (0, 0, 1))
+    segments = holder_profile.mesh_edge_segments(cylindrical, indices)
+    # each tube has two rings, the edges along it and the diagonals
+    assert len(segments) == 3 * sides * 4
+    profile = holder_profile.upper_envelope(segments)
+    assert [[round(value, 9) for value in segment] for segment in profile] == [[0, 1, 2, 2], [1, 3, 1, 1]]
+
+def test_upper_envelope_is_the_highest_segment_everywhere():
+    random.seed(5)
+    segments = []
+    for _ in range(2000):
+        z_1 = random.uniform(0, 10)
+        segments.append((random.uniform(1, 2), random.uniform(1, 2), z_1, z_1 + random.uniform(0.01, 3)))
+    profile = holder_profile.upper_envelope(segments)
+    for z in [random.uniform(0.5, 10) for _ in range(200)]:
+        highest = max(r_1 + (r_2 - r_1) * (z - z_1) / (z_2 - z_1) for r_1, r_2, z_1, z_2 in segments if z_1 <= z <= z_2)
+        assert abs(radius_at(profile, z) - highest) < 1e-9
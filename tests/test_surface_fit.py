@@ -0,0 +1,88 @@
+import math
+
+from conftest import load_module
+
+surface_fit = load_module('surface_fit', 'commands', 'cleanChamfer', 'surface_fit.py')
+
+def arc(center, radius, start, end, z, samples):
+    return [(center[0] + radius * math.cos(start + (end - start) * j / samples), center[1] + radius * math.sin(start + (end - start) * j / samples), z) for j in range(samples + 1)]
+
+def line(a, b, samples):
+    return [tuple(a[d] + (b[d] - a[d]) * j / samples for d in range(3)) for j in range(samples + 1)]
+
+def rounded_rectangle(width, height, radius, z, samples, split=1):
+    # The edges of a rounded rectangle going counterclockwise from the start of the first corner, every arc and line is cut into split edges
+    corners = [(width / 2 - radius, height / 2 - radius), (-width / 2 + radius, height / 2 - radius), (-width / 2 + radius, -height / 2 + radius), (width / 2 - radius, -height / 2 + radius)]
+    edges = []
+    for k, corner in enumerate(corners):
+        start = k * math.pi / 2
+        for q in range(split):
+            edges.append(arc(corner, radius, start + math.pi / 2 * q / split, start + math.pi / 2 * (q + 1) / split, z, samples))
+        end = (k + 1) * math.pi / 2
+        following = corners[(k + 1) % 4]
+        a = (corner[0] + radius * math.cos(end), corner[1] + radius * math.sin(end), z)
+        b = (following[0] + radius * math.cos(end), following[1] + radius * math.sin(end), z)
+        for q in range(split):
+            edges.append(line(tuple(a[d] + (b[d] - a[d]) * q / split for d in range(3)), tuple(a[d] + (b[d] - a[d]) * (q + 1) / split for d in range(3)), samples))
+    return edges
+
+def join(edges):
+    polyline = list(edges[0])
+    for edge in edges[1:]:
+        polyline += edge[1:]
+    return polyline
+
+def chamfer_ring(split):
+    # A chamfer around the top of a rounded rectangle pocket, the rails are where each arc meets each line
+    edges_1 = rounded_rectangle(5, 3, 0.5, 0, 16, split)
+    edges_2 = rounded_rectangle(4.8, 2.8, 0.4, 0.1, 16, split)
+    rails = [(edges_1[k][0], edges_2[k][0]) for k in range(0, len(edges_1), split)]
+    junctions = [edge[0] for edge in edges_1 + edges_2]
+    return join(edges_1), join(edges_2), rails, junctions
+
+def closest_on_curve(surface, v, point, steps=4000):
+    return min(range(steps + 1), key=lambda i: surface_fit.distance(surface_fit.evaluate_surface(surface, i / steps, v), point)) / steps
+
+def test_open_chain_fits_within_tolerance_and_keeps_its_ends():
+    boundary_1 = join([line((0, 0, 0), (2, 0, 0), 16), arc((2, 1, 0), 1, -math.pi / 2, 0, 0, 16)])
+    boundary_2 = join([line((0, 0.1, 0.1), (2, 0.1, 0.1), 16), arc((2, 1, 0.1), 0.9, -math.pi / 2, 0, 0.1, 16)])
+    rails = [(boundary_1[0], boundary_2[0]), (boundary_1[-1], boundary_2[-1])]
+    fitted = surface_fit.fit_ruled_surface(boundary_1, boundary_2, rails, [(2, 0, 0), (2, 0.1, 0.1)], tolerance=0.005)
+    assert fitted.max_deviation <= 0.005
+    # one cubic for the line and one for the arc
+    assert len(fitted.control_points[0]) == 7
+    assert surface_fit.distance(surface_fit.evaluate_surface(fitted, 0, 0), boundary_1[0]) < 1e-9
+    assert surface_fit.distance(surface_fit.evaluate_surface(fitted, 1, 1), boundary_2[-1]) < 1e-9
+
+def test_closed_ring_fits_with_one_piece_per_edge():
+    boundary_1, boundary_2, rails, junctions = chamfer_ring(1)
+    fitted = surface_fit.fit_ruled_surface(boundary_1, boundary_2, rails, junctions, closed=True, tolerance=0.005)
+    assert fitted.max_deviation <= 0.005
+    assert len(fitted.control_points[0]) == 8 * 3 + 1
+    # the seam is closed
+    for v in (0, 1):
+        assert surface_fit.distance(surface_fit.evaluate_surface(fitted, 0, v), surface_fit.evaluate_surface(fitted, 1, v)) < 1e-9
+
+def test_rails_are_isocurves():
+    boundary_1, boundary_2, rails, junctions = chamfer_ring(1)
+    fitted = surface_fit.fit_ruled_surface(boundary_1, boundary_2, rails, junctions, closed=True, tolerance=0.005)
+    for start, end in rails:
+        u = closest_on_curve(fitted, 0, start)
+        assert surface_fit.distance(surface_fit.evaluate_surface(fitted, u, 0), start) < 0.005
+        assert surface_fit.distance(surface_fit.evaluate_surface(fitted, u, 1), end) < 0.005
+
+def test_sixteen_edge_ring_is_not_singular():
+    # 257 samples used to double the control points up to 256 and leave knot spans without any samples
+    boundary_1, boundary_2, rails, junctions = chamfer_ring(2)
+    assert len(boundary_1) == 257
+    for breaks in (junctions, []):
+        fitted = surface_fit.fit_ruled_surface(boundary_1, boundary_2, rails, breaks, closed=True, tolerance=0.005)
+        assert fitted.max_deviation <= 0.005
+        assert len(fitted.control_points[0]) < 64
+
+def test_schoenberg_whitney_needs_a_sample_per_control_point():
+    params = [i / 10 for i in range(11)]
+    assert surface_fit.schoenberg_whitney(surface_fit.interpolation_knots(params, 3), 3, params)
+    # seven knots between the first two samples leaves most control points without a sample
+    crowded = [0.0] * 4 + [0.01 * j for j in range(1, 8)] + [1.0] * 4
+    assert not surface_fit.schoenberg_whitney(crowded, 3, params)
@@ -0,0 +1,38 @@
+import json
+
+from conftest import load_module
+
+tool_index = load_module('tool_index', 'commands', 'updateTools', 'tool_index.py')
+
+def tool_text(unit: str, diameter: float, description: str = 'end mill') -> str:
+    return json.dumps({"description": description, "type": "flat end mill", "unit": unit,
+                       "geometry": {"DC": diameter, "LCF": 0.5 if unit == 'inches' else 12.7, "NOF": 4},
+                       "start-values": {"presets": [{"name": "Aluminum"}]}})
+
+def test_inch_tool_matches_metric_tool_within_a_hundredth():
+    index = tool_index.ToolIndex.from_tools('library', 'marker', [tool_text('millimeters', 6.3627)])
+    # 0.2505 in is 6.3627 mm, rounded to .3f it would be 0.251 in and over 0.01 mm away
+    keys = tool_index.tool_keys(tool_text('inches', 0.2505))
+    position, distance = index.find_nearest(keys, 0.01)
+    assert position == 0
+    assert distance < 0.1
+
+def test_nearest_geometry_needs_the_same_flute_count():
+    index = tool_index.ToolIndex.from_tools('library', 'marker', [tool_text('millimeters', 6.0)])
+    keys = tool_index.tool_keys(tool_text('millimeters', 6.0).replace('"NOF": 4', '"NOF": 3'))
+    assert index.find_nearest(keys, 0.01) == (None, None)
+
+def test_exact_lookups_ignore_empty_keys():
+    index = tool_index.ToolIndex.from_tools('library', 'marker', [tool_text('millimeters', 6.0, description='')])
+    keys = tool_index.tool_keys(tool_text('millimeters', 6.0, description=''))
+    assert index.find('Description', keys) is None
+    assert index.find('Geometry', keys) == 0
+
+def test_tool_hash_ignores_tip_keys_and_last_modified_but_not_presets():
+    tool = json.loads(tool_text('millimeters', 6.0))
+    reopened = json.loads(tool_text('millimeters', 6.0))
+    reopened["last_modified"] = 1700000000
+    reopened["geometry"]["tip-diameter"] = 0
+    assert tool_index.tool_hash(tool) == tool_index.tool_hash(reopened)
+    reopened["start-values"]["presets"].append({"name": "Steel"})
+    assert tool_index.tool_hash(tool) != tool_index.tool_hash(reopened)